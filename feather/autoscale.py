@@ -0,0 +1,96 @@
+import math
+import time
+
+
+__all__ = ["Autoscaler"]
+
+
+class Autoscaler(object):
+    """a policy for growing and shrinking a Monitor's worker count with load
+
+    every `interval` seconds the Monitor hands it the scoreboard slots of its
+    workers, and it returns the number of workers there should be.
+
+    load is measured with `metric`, either
+
+    busy
+        request-seconds handled per second, from the slots' busy_time. for a
+        worker handling one request at a time this is the fraction of the
+        time it's busy, and it grows past 1 with concurrent requests
+
+    connections
+        the number of open client connections
+
+    the desired count is the total load divided by `target` (the load each
+    worker should carry), kept between `min_workers` and `max_workers`.
+
+    after any change in the worker count, another increase waits for at least
+    `scale_up_cooldown` seconds and a decrease for `scale_down_cooldown`.
+    decreases go one worker at a time (or straight down to max_workers, if
+    there are more than that), so a brief lull doesn't throw away capacity
+    that will be needed again right away.
+    """
+    metrics = ("busy", "connections")
+
+    def __init__(self, min_workers, max_workers, target=0.7, metric="busy",
+            scale_up_cooldown=30, scale_down_cooldown=300, interval=5):
+        if metric not in self.metrics:
+            raise ValueError("unknown autoscaling metric %r" % (metric,))
+        if not 0 < min_workers <= max_workers:
+            raise ValueError("need 0 < min_workers <= max_workers")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target = target
+        self.metric = metric
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.interval = interval
+
+        self.load = None
+        self._last_change = 0
+        self._sample = None
+
+    def clamp(self, count):
+        return max(self.min_workers, min(self.max_workers, count))
+
+    def measure(self, slots, now):
+        "the current total load of the workers in `slots`, or None if unknown"
+        if self.metric == "connections":
+            return sum(slot.get("connections") for slot in slots)
+
+        busy = dict((slot.get("pid"), slot.get("busy_time")) for slot in slots)
+        previous, self._sample = self._sample, (now, busy)
+        if previous is None:
+            return None
+
+        then, before = previous
+        if now <= then:
+            return None
+
+        # workers that started during the interval began at zero. those that
+        # exited took their busy time with them, which undercounts a little
+        spent = sum(total - before.get(pid, 0) for pid, total in busy.items())
+        return max(spent, 0) / (now - then)
+
+    def decide(self, current, slots, now=None):
+        "the number of workers to run, given the current count and slots"
+        if now is None:
+            now = time.time()
+
+        load = self.load = self.measure(slots, now)
+        if load is None:
+            return self.clamp(current)
+
+        desired = self.clamp(int(math.ceil(load / self.target)))
+        since = now - self._last_change
+
+        if desired > current and since >= self.scale_up_cooldown:
+            pass
+        elif desired < current and since >= self.scale_down_cooldown:
+            # one at a time, but never left above max_workers
+            desired = min(current - 1, self.max_workers)
+        else:
+            return self.clamp(current)
+
+        self._last_change = now
+        return desired
@@ -0,0 +1,271 @@
+import collections
+import email.utils
+import time
+
+from feather import http
+import greenhouse
+
+
+__all__ = ["ResponseCache", "Coalescer"]
+
+
+def request_key(request, vary=()):
+    """a key identifying equivalent requests, or None if there can't be one
+
+    only GETs without an Authorization header are considered. the key is made
+    from the host, path and querystring and the values of the (lowercased)
+    request header names in `vary`.
+    """
+    if request.method != 'GET' or 'authorization' in request.headers:
+        return None
+    return (request.method, request.host, request.path, request.querystring,
+            tuple(request.headers.get(name) for name in vary))
+
+
+def shareable(headers, vary=()):
+    """whether response headers allow the response to go to other clients
+
+    it mustn't set a cookie, be marked "private", "no-store" or "no-cache", or
+    have a Vary header naming anything not in `vary` (lowercased names).
+    """
+    for name, value in headers:
+        name = name.lower()
+        if name == 'set-cookie':
+            return False
+        elif name == 'vary':
+            for field in value.split(','):
+                if field.strip().lower() not in vary:
+                    return False
+        elif name == 'cache-control':
+            for directive in value.split(','):
+                # with or without arguments, as in private="Set-Cookie"
+                if directive.split('=', 1)[0].strip().lower() in (
+                        'no-store', 'no-cache', 'private'):
+                    return False
+    return True
+
+
+class _Entry(object):
+    __slots__ = ["expires", "code", "head", "body", "size"]
+
+    def __init__(self, expires, code, head, body):
+        self.expires = expires
+        self.code = code
+        self.head = head
+        self.body = body
+        self.size = len(head) + len(body)
+
+
+class ResponseCache(object):
+    """a per-process LRU cache of complete responses
+
+    only GET requests are cached, keyed with request_key() on the host, path,
+    querystring and the values of the headers named in `vary`. requests with
+    an Authorization header are passed through untouched, as the response may
+    be for that client's eyes only and the key doesn't include the
+    credentials anyway. a response is
+    stored if it has a cacheable status code and its Cache-Control (s-maxage
+    or max-age) or Expires header gives it a lifetime. without either one,
+    `default_ttl` seconds is used, so a small default_ttl makes this a
+    microcache for apps that don't send caching headers at all.
+
+    responses that aren't shareable() are never stored.
+
+    the least recently used entries are evicted to keep the total size of
+    cached heads and bodies within `max_bytes`.
+    """
+    cacheable_codes = frozenset([200, 203, 300, 301, 404, 410])
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, vary=(), default_ttl=0):
+        self.max_bytes = max_bytes
+        self.vary = tuple(name.lower() for name in vary)
+        self.default_ttl = default_ttl
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def key(self, request):
+        "the cache key for an HTTPRequest, or None if it can't be cached"
+        return request_key(request, self.vary)
+
+    def get(self, key):
+        "the unexpired entry for `key`, or None"
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry.expires <= time.time():
+            self.size -= entry.size
+            self.misses += 1
+            return None
+
+        # re-insert at the most-recently-used end
+        self._entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def ttl(self, code, headers):
+        "seconds a response may be cached for, given its code and headers"
+        if code not in self.cacheable_codes or not shareable(
+                headers, self.vary):
+            return 0
+
+        max_age = s_maxage = expires = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'cache-control':
+                for directive in value.split(','):
+                    directive, _, arg = directive.strip().lower().partition('=')
+                    try:
+                        if directive == 'max-age':
+                            max_age = int(arg.strip('"'))
+                        elif directive == 's-maxage':
+                            s_maxage = int(arg.strip('"'))
+                    except ValueError:
+                        return 0
+            elif name == 'expires':
+                parsed = email.utils.parsedate_tz(value)
+                expires = parsed and email.utils.mktime_tz(parsed) or 0
+
+        if s_maxage is not None:
+            return s_maxage
+        if max_age is not None:
+            return max_age
+        if expires is not None:
+            return expires - time.time()
+        return self.default_ttl
+
+    def store(self, key, code, headers, body, http_version=(1, 1)):
+        """cache a complete response, if its code and headers allow it
+
+        the status line and headers are formatted here, once, so that a hit
+        can be sent with a single write. any Connection or Content-Length
+        header is replaced, as they depend on the connection serving the hit.
+        """
+        ttl = self.ttl(code, headers)
+        if ttl <= 0:
+            return
+
+        headers = [(name, value) for name, value in headers
+                if name.lower() not in ('connection', 'content-length')]
+        headers.append(('Content-Length', str(len(body))))
+
+        head = 'HTTP/%s %d %s\r\n%s\r\n' % (
+                '.'.join(map(str, http_version)),
+                code,
+                http.responses[code][0],
+                '\r\n'.join('%s: %s' % (k, v.replace('\n', '\n '))
+                    for k, v in headers))
+
+        entry = _Entry(time.time() + ttl, code, head, body)
+        if entry.size > self.max_bytes:
+            return
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+
+        self._entries[key] = entry
+        self.size += entry.size
+
+        while self.size > self.max_bytes:
+            key, old = self._entries.popitem(last=False)
+            self.size -= old.size
+
+    def collect(self, key, code, headers, body, http_version=(1, 1)):
+        """pass through a response body iterable, storing it once it's complete
+
+        returns an iterable to use in place of `body`. the response is only
+        stored if the body is fully iterated (so not if the client goes away).
+        """
+        if self.ttl(code, headers) <= 0:
+            return body
+
+        if isinstance(body, (list, tuple)):
+            body = ''.join(body)
+
+        if isinstance(body, str):
+            self.store(key, code, headers, body, http_version)
+            return body
+
+        def iterator():
+            chunks = []
+            for chunk in body:
+                chunks.append(chunk)
+                yield chunk
+            self.store(key, code, headers, ''.join(chunks), http_version)
+
+        return iterator()
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+class _Flight(object):
+    __slots__ = ["done", "result", "exc_info"]
+
+    def __init__(self):
+        self.done = greenhouse.Event()
+        self.result = self.exc_info = None
+
+
+class Coalescer(object):
+    """collapses identical concurrent GETs into a single run of the app
+
+    requests are keyed with request_key() and `vary` just like ResponseCache.
+    the first request for a key runs the app and buffers the response, and
+    any more that arrive before it has finished wait for it and get a copy.
+    if the app raises, the waiters raise the same exception. waiters give up
+    with a 503 after `timeout` seconds, and if the response isn't shareable()
+    they run the app themselves after all.
+    """
+    def __init__(self, vary=(), timeout=30):
+        self.vary = tuple(name.lower() for name in vary)
+        self.timeout = timeout
+        self.coalesced = 0
+        self._flights = {}
+
+    def key(self, request):
+        "the coalescing key for an HTTPRequest, or None if it can't be shared"
+        return request_key(request, self.vary)
+
+    def join(self, key):
+        """the in-progress flight for `key` to wait() on
+
+        returns None, and starts a new flight, if there wasn't one already. in
+        that case the caller must follow up with finish() or fail().
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            self._flights[key] = _Flight()
+        else:
+            self.coalesced += 1
+        return flight
+
+    def finish(self, key, code, headers, body):
+        "complete the flight for `key` with a response body string"
+        flight = self._flights.pop(key)
+        if shareable(headers, self.vary):
+            flight.result = (code, list(headers), body)
+        flight.done.set()
+
+    def fail(self, key, exc_info):
+        "complete the flight for `key` with an exception"
+        flight = self._flights.pop(key)
+        flight.exc_info = exc_info
+        flight.done.set()
+
+    def wait(self, flight):
+        """wait for another request's response
+
+        returns the (code, headers, body) triple, or None if the response
+        can't be shared. re-raises the exception if the app raised one.
+        """
+        if flight.done.wait(self.timeout):
+            raise http.HTTPError(503)
+        if flight.exc_info is not None:
+            klass, exc, tb = flight.exc_info
+            raise klass, exc, tb
+        return flight.result
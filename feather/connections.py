@@ -6,11 +6,90 @@ import os
 import socket
 import sys
 
-from feather import requests
+from feather import requests, util
 import greenhouse
 
 
-__all__ = ["TCPConnection"]
+__all__ = ["RequestTimeout", "RequestTimings", "TCPConnection"]
+
+
+class RequestTimeout(Exception):
+    """raised in a connection's coroutine when its request runs out of time
+
+    see TCPServer.request_timeout and TCPConnection.set_deadline()
+    """
+
+
+class RequestTimings(object):
+    """timestamps of the phases of a single request
+
+    they all come from feather.util.monotonic(), so only differences between
+    them mean anything. a phase that hasn't happened (yet) is None.
+
+    accepted
+        when the connection was accepted. for later requests on a keep-alive
+        connection, when the previous request finished
+
+    scheduled
+        when the connection's coroutine first ran after it was accepted. None
+        for later requests on a keep-alive connection, whose waits for the
+        scheduler can't be told apart from waiting on the client
+
+    first_read
+        when the start of the request had been read
+
+    headers_parsed
+        when the request's headers had been read and parsed
+
+    handler_start, handler_end
+        around the request handler's handle() (or handle_error()) call. a
+        lazy response's iterator runs later, while the response is written
+
+    first_write, last_write
+        when the first and last chunks of the response had been sent
+    """
+    __slots__ = ["accepted", "scheduled", "first_read", "headers_parsed",
+            "handler_start", "handler_end", "first_write", "last_write"]
+
+    def __init__(self, accepted=None):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.accepted = accepted
+
+    def mark(self, phase):
+        setattr(self, phase, util.monotonic())
+
+    def between(self, start, end):
+        "seconds from one phase to another, or None if either didn't happen"
+        start, end = getattr(self, start), getattr(self, end)
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @property
+    def queue(self):
+        "time spent waiting for the scheduler to get to the connection"
+        return self.between("accepted", "scheduled")
+
+    @property
+    def read(self):
+        "time spent reading the request line and headers"
+        return self.between("first_read", "headers_parsed")
+
+    @property
+    def handle(self):
+        "time spent in the request handler"
+        return self.between("handler_start", "handler_end")
+
+    @property
+    def write(self):
+        "time spent sending the response"
+        return self.between("first_write", "last_write")
+
+    @property
+    def total(self):
+        "from the start of the request to the end of the response"
+        return self.between("first_read", "last_write")
 
 
 class TCPConnection(object):
@@ -28,6 +107,10 @@ class TCPConnection(object):
     the super method though, as TCPConnection.cleanup is needed
 
     setup() can similarly be overridden to do setup work for new connections.
+
+    the timings attribute is a RequestTimings for the request currently being
+    read or handled. log_access() can use it to break down where the time
+    went.
     """
 
     # set this attribute to something that implements handle()
@@ -40,6 +123,10 @@ class TCPConnection(object):
         self.server = server
         self.closing = False
         self.push_lock = greenhouse.Lock()
+        self.timings = RequestTimings(util.monotonic())
+        self.greenlet = None
+        self.deadline = None
+        self.timed_out = False
 
     # be sure and implement this in concrete subclasses
     def get_request(self):
@@ -67,11 +154,36 @@ class TCPConnection(object):
                         break
                     raise
                 sent += len(chunk)
+                self.timings.mark("last_write")
+                if self.timings.first_write is None:
+                    self.timings.first_write = self.timings.last_write
         return sent
 
+    def set_deadline(self, seconds):
+        """give the current request `seconds` from now to finish
+
+        when the time is up, RequestTimeout is raised wherever the request's
+        coroutine is paused, and the connection is closed after it. None
+        removes the deadline.
+        """
+        if seconds is None:
+            self.deadline = None
+            self.server.unwatch_deadline(self)
+        else:
+            self.deadline = util.monotonic() + seconds
+            self.server.watch_deadline(self)
+
     def serve_all(self):
+        self.timings.mark("scheduled")
+        self.greenlet = greenhouse.compat.getcurrent()
         self.setup()
 
+        slot = self.server.scoreboard_slot
+        if slot is not None:
+            slot.incr("connections")
+            if self.server.tls:
+                slot.incr("tls_handshakes")
+
         while not self.closing and not self.server.shutting_down:
             handler = self.request_handler(
                     self.client_address,
@@ -87,8 +199,13 @@ class TCPConnection(object):
             except Exception:
                 klass, exc, tb = sys.exc_info()
                 self.server.connections.increment()
+                if slot is not None:
+                    slot.incr("active")
+                self.timings.mark("handler_start")
+                self.request_started(None)
                 self.log_error(klass, exc, tb)
                 response, metadata = handler.handle_error(klass, exc, tb)
+                self.timings.mark("handler_end")
                 klass, exc, tb = None, None, None
                 access_time = datetime.datetime.now()
             else:
@@ -96,7 +213,17 @@ class TCPConnection(object):
                     # indicates timeout or connection terminated by client
                     break
 
+                if not self.server.admit_request(self):
+                    self.shed_request(request)
+                    break
+
                 self.server.connections.increment()
+                if slot is not None:
+                    slot.incr("active")
+                self.timings.mark("handler_start")
+                if self.server.request_timeout is not None:
+                    self.set_deadline(self.server.request_timeout)
+                self.request_started(request)
                 access_time = datetime.datetime.now()
 
                 try:
@@ -106,10 +233,12 @@ class TCPConnection(object):
                     self.log_error(klass, exc, tb)
                     response, metadata = handler.handle_error(klass, exc, tb)
                     klass, exc, tb = None, None, None
+                self.timings.mark("handler_end")
 
             # the return value from handler.handle may be a generator or
             # other lazy iterator to allow for large responses that send
             # in chunks and don't block the entire server the whole time
+            sent = 0
             try:
                 # this needs to be in a try block as well since the
                 # handler.handle() above could have returned a generator, in
@@ -120,15 +249,63 @@ class TCPConnection(object):
                 self.log_error(*sys.exc_info())
             else:
                 self.log_access(access_time, request, metadata, sent)
+                if slot is not None:
+                    slot.incr("requests")
+                    slot.incr("bytes_received", self.received(request))
+                    slot.incr("bytes_sent", sent)
+                    code = self.response_code(metadata)
+                    if code is not None and 100 <= code < 600:
+                        slot.incr("responses", 1, code // 100 - 1)
+                    self._record_timings(slot)
             finally:
                 self.server.connections.decrement()
+                if slot is not None:
+                    slot.incr("active", -1)
+                    slot.incr("busy_time",
+                            util.monotonic() - self.timings.handler_start)
+                if self.deadline is not None:
+                    self.set_deadline(None)
+                if self.timed_out:
+                    self.timed_out = False
+                    if slot is not None:
+                        slot.incr("timeouts")
+                self.request_finished(sent)
 
             del handler, request
 
+            # the next request's wait starts now
+            self.timings = RequestTimings(util.monotonic())
+
         self._cleanup()
 
+    def _record_timings(self, slot):
+        timings = self.timings
+        elapsed = timings.between("handler_start", "last_write") or 0
+        slot.record_time(elapsed)
+        slot.incr("handle_sum", elapsed)
+        for field, seconds in (
+                ("queue_times", timings.queue),
+                ("read_times", timings.read),
+                ("app_times", timings.handle),
+                ("write_times", timings.write)):
+            if seconds is not None:
+                slot.record_time(seconds, field)
+
+    def shed_request(self, request):
+        "turn the connection away instead of handling `request`"
+        self.closing = True
+        sock, self.socket = self.socket, None
+        self.server.shed(sock, "requests")
+
     def _cleanup(self):
+        self.server.open_connections -= 1
         self.cleanup()
+        slot = self.server.scoreboard_slot
+        if slot is not None:
+            slot.incr("connections", -1)
+        if self.socket is None:
+            # handed off by shed_request
+            return
         try:
             os.close(self.socket.fileno())
             self.socket.close()
@@ -141,6 +318,28 @@ class TCPConnection(object):
         "override to add to connection cleanup"
         pass
 
+    def received(self, request):
+        "override to return the number of bytes read for a request"
+        return 0
+
+    def request_started(self, request):
+        """override to act on a request as its handler starts
+
+        request is None if get_request() raised and the handler is producing
+        an error response instead
+        """
+        pass
+
+    def request_finished(self, sent):
+        """override to act on a request after its response (successful or
+        not) is done. sent is the number of bytes of it that were sent
+        """
+        pass
+
+    def response_code(self, metadata):
+        "override to return a request's status code (1xx-5xx) from metadata"
+        return None
+
     def log_access(self, access_time, request, metadata, sent):
         pass
 
@@ -0,0 +1,133 @@
+import gc
+import logging
+import os
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from greenhouse import compat
+
+
+__all__ = ["format_stacks", "Watchdog"]
+
+
+log = logging.getLogger("feather.diagnostics")
+
+
+def format_stacks():
+    """the current stack of every thread and every live greenlet, as text
+
+    a greenlet's stack is only available while it's suspended, the running
+    one in each thread shows up in that thread's stack instead.
+    """
+    sections = []
+
+    for ident, frame in sys._current_frames().items():
+        sections.append("thread %d:\n%s" % (
+            ident, "".join(traceback.format_stack(frame))))
+
+    for obj in gc.get_objects():
+        if not isinstance(obj, compat.greenlet) or obj.dead:
+            continue
+        if obj.gr_frame is None:
+            continue
+        sections.append("greenlet %r:\n%s" % (
+            obj, "".join(traceback.format_stack(obj.gr_frame))))
+
+    return "\n".join(sections)
+
+
+class Watchdog(object):
+    """an OS thread that keeps an eye on a worker from outside its scheduler
+
+    a worker whose scheduler is stuck (a greenlet blocking in a C call, or in
+    a loop that never yields) can't service anything from a coroutine, but
+    this thread still runs whenever the stuck code releases the GIL. every
+    `interval` seconds it checks the worker's scoreboard slot, and when the
+    master has set "dump_requested" it writes format_stacks() to a file in
+    `dump_dir` and clears the flag.
+
+    with a `lag_threshold`, it also watches the "tick" the worker's
+    scheduler writes to the slot every `tick_interval` seconds. when a tick
+    is overdue by more than lag_threshold, the scheduler is blocked right
+    now, so it samples the main thread's stack. samples are counted by
+    stack, the first one of each stall is logged, and the counts are
+    included in dumps.
+
+    like ThreadPool, this needs the real threading and time modules, so it
+    won't work with greenhouse's emulation of those patched in.
+    """
+    def __init__(self, slot, dump_dir, interval=0.5, lag_threshold=None,
+            tick_interval=0.1):
+        self.slot = slot
+        self.dump_dir = dump_dir
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.tick_interval = tick_interval
+        self.blocking_stacks = {}
+        self.stalled = False
+        self.thread = None
+        # created in the thread that will run the scheduler
+        self.main_thread = thread.get_ident()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while 1:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def check(self):
+        if self.slot.get("dump_requested"):
+            self.dump()
+            self.slot.set("dump_requested", 0)
+
+        if self.lag_threshold is not None:
+            overdue = time.time() - self.slot.get("tick") - self.tick_interval
+            if overdue > self.lag_threshold:
+                self.sample(overdue)
+            else:
+                self.stalled = False
+
+    def sample(self, overdue):
+        "record the stack the scheduler's thread is stuck in"
+        frame = sys._current_frames().get(self.main_thread)
+        if frame is None:
+            return
+        stack = tuple(traceback.extract_stack(frame))
+        del frame
+        self.blocking_stacks[stack] = self.blocking_stacks.get(stack, 0) + 1
+
+        if not self.stalled:
+            self.stalled = True
+            log.warn("scheduler blocked for %.3f seconds in:\n%s" % (
+                overdue, "".join(traceback.format_list(stack))))
+
+    def format_blocking_stacks(self):
+        stacks = sorted(self.blocking_stacks.items(),
+                key=lambda item: -item[1])
+        return "\n".join("%d samples:\n%s" % (
+            count, "".join(traceback.format_list(stack)))
+            for stack, count in stacks)
+
+    def dump(self, reason="dump requested by the master"):
+        "write the stacks to a new file in dump_dir, returning its path"
+        now = time.time()
+        path = os.path.join(self.dump_dir, "%d-%d.txt" % (os.getpid(), now))
+        with open(path, 'w') as fp:
+            fp.write("pid %d, worker %d, %s at %s\n\n%s" % (
+                os.getpid(), self.slot.get("wid"), reason,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+                format_stacks()))
+            if self.blocking_stacks:
+                fp.write("\nstacks sampled while the scheduler was "
+                        "blocked:\n\n%s" % self.format_blocking_stacks())
+        return path
@@ -1,4 +1,5 @@
 import BaseHTTPServer
+import collections
 import httplib
 import itertools
 import logging
@@ -8,7 +9,7 @@ import time
 import traceback
 import urlparse
 
-from feather import connections, requests, servers
+from feather import connections, pools, requests, servers, util
 import greenhouse
 
 
@@ -55,6 +56,9 @@ class HTTPRequest(object):
         the IP address from which the connection has been made. if a reverse
         proxy is in use this won't correspond to the client's real IP address,
         but the proxy is probably adding a header indicating that.
+
+    timings
+        the connection's feather.connections.RequestTimings for this request
     '''
     __slots__ = [
             "request_line",
@@ -67,7 +71,8 @@ class HTTPRequest(object):
             "fragment",
             "headers",
             "content",
-            "remote_ip"]
+            "remote_ip",
+            "timings"]
 
     def __init__(self, **kwargs):
         for name in self.__slots__:
@@ -120,8 +125,12 @@ class HTTPRequestHandler(requests.RequestHandler):
 
     do_* methods should set response data with HTTPRequestHandler methods
     set_code, set_body, add_header, add_headers.
+
+    set process_pool to a feather.pools.ProcessPool to make offload()
+    available for running CPU-bound work outside of the worker process.
     """
     traceback_body = False
+    process_pool = None
 
     def __init__(self, *args, **kwargs):
         super(HTTPRequestHandler, self).__init__(*args, **kwargs)
@@ -176,6 +185,17 @@ class HTTPRequestHandler(requests.RequestHandler):
                 offset += 1
         return removed
 
+    def offload(self, func, *args, **kwargs):
+        """run func(*args, **kwargs) in the process_pool and return the result
+
+        only the current coroutine waits for the result, the rest of the
+        worker keeps serving. func, its arguments and its return value must
+        all be picklable. if the pool's queue is full the request gets a 503.
+        """
+        if self.process_pool is None:
+            raise RuntimeError("no process_pool to offload to")
+        return self.process_pool.run(func, *args, **kwargs)
+
     def _translate_http_error(self, error):
         self.set_code(error.code)
         self.add_headers(error.headers)
@@ -241,12 +261,20 @@ class HTTPRequestHandler(requests.RequestHandler):
         except HTTPError, error:
             self._translate_http_error(error)
 
+        except pools.PoolFull:
+            self._translate_http_error(HTTPError(503))
+
         except NotImplementedError:
             self._translate_http_error(HTTPError(405))
 
         return self._format_response()
 
     def handle_error(self, klass, exc, tb):
+        if issubclass(klass, connections.RequestTimeout):
+            # drop whatever the handler had set up for its own response
+            self._headers = []
+            self._translate_http_error(HTTPError(504))
+            return self._format_response()
         if self.traceback_body:
             self.set_body(traceback.format_exception(klass, exc, tb))
         self.set_code(500)
@@ -311,6 +339,7 @@ class HTTPConnection(connections.TCPConnection):
 
         if not request_line:
             return None
+        self.timings.mark("first_read")
 
         try:
             method, path, version_string = request_line.split(' ', 2)
@@ -332,6 +361,7 @@ class HTTPConnection(connections.TCPConnection):
             return None
 
         headers = self.header_class(content)
+        self.timings.mark("headers_parsed")
         content._ignore_length = False
         content._reset_collected()
 
@@ -360,7 +390,8 @@ class HTTPConnection(connections.TCPConnection):
                 fragment=url.fragment,
                 headers=headers,
                 content=content,
-                remote_ip=self.client_address[0])
+                remote_ip=self.client_address[0],
+                timings=self.timings)
 
     @staticmethod
     def format_datetime(dt):
@@ -392,9 +423,62 @@ class HTTPConnection(connections.TCPConnection):
             return request.headers['x-real-ip'].strip()
         return request.remote_ip
 
+    def response_code(self, metadata):
+        return metadata[0]
+
+    def request_started(self, request):
+        if self.server.slow_request_threshold is not None:
+            self.server.track_request(self, request)
+
+    def request_finished(self, sent):
+        if self.server.slow_request_threshold is None:
+            return
+        request, samples = self.server.untrack_request(self)
+        elapsed = util.monotonic() - self.timings.handler_start
+        if elapsed >= self.server.slow_request_threshold:
+            self.log_slow(request, sent, elapsed, samples)
+
+    def log_slow(self, request, sent, elapsed, samples):
+        timings = self.timings
+        if request is None:
+            request_line, client, received = "-", self.client_address[0], 0
+        else:
+            request_line = request.request_line.rstrip()
+            client = self._get_browser_ip(request)
+            received = self.received(request)
+
+        lines = ['%.3f ms "%s" from %s, %d bytes in, %d bytes out' % (
+                elapsed * 1000, request_line, client, received, sent)]
+        lines.append("phases (ms): queue %s, read %s, handle %s, write %s" % (
+                self.format_ms(timings.queue), self.format_ms(timings.read),
+                self.format_ms(timings.handle),
+                self.format_ms(timings.write)))
+
+        counts = collections.defaultdict(int)
+        for stack in samples:
+            counts[stack] += 1
+        for stack, count in sorted(counts.items(), key=lambda i: -i[1]):
+            lines.append("%d of %d stack samples:\n%s" % (
+                count, len(samples), stack.rstrip("\n")))
+
+        self.server.slow_log.warning("\n".join(lines))
+
+    def received(self, request):
+        head = len(request.request_line) + 2
+        if hasattr(request.headers, 'headers'):
+            head += sum(len(line) for line in request.headers.headers)
+        return head + request.content.collected
+
+    @staticmethod
+    def format_ms(seconds):
+        if seconds is None:
+            return "-"
+        return "%.3f" % (seconds * 1000)
+
     def log_access(self, access_time, request, metadata, sent):
         code, head_len = metadata
         body_len = sent - head_len
+        timings = self.timings
         self.server.access_log.info(self.server.access_log_format % {
             'ip': self._get_browser_ip(request),
             'time': self.format_datetime(access_time),
@@ -403,6 +487,11 @@ class HTTPConnection(connections.TCPConnection):
             'body_len': body_len,
             'referer': request.headers.get("http-referer", "-"),
             'user_agent': request.headers.get("user-agent", "-"),
+            'queue_ms': self.format_ms(timings.queue),
+            'read_ms': self.format_ms(timings.read),
+            'handle_ms': self.format_ms(timings.handle),
+            'write_ms': self.format_ms(timings.write),
+            'total_ms': self.format_ms(timings.total),
         })
 
     def log_error(self, klass, exc, tb):
@@ -412,19 +501,82 @@ class HTTPConnection(connections.TCPConnection):
 
 class HTTPServer(servers.TCPServer):
     """
+    besides the defaults, access_log_format can use the request phase
+    durations queue_ms, read_ms, handle_ms, write_ms and total_ms (see
+    feather.connections.RequestTimings), each in milliseconds or "-".
+
+    with slow_request_threshold set (in seconds), any request that takes at
+    least that long from the start of its handler to the end of its response
+    is logged to the "feather.http.slow" logger, with its phase timings and
+    up to slow_request_samples stack samples. the samples are taken evenly
+    over the threshold while the request's greenlet is paused, so they show
+    where it was waiting. a request that never pauses can't be sampled here,
+    Monitor's lag_threshold catches those.
     """
     connection_handler = HTTPConnection
 
     access_log_format = '%(ip)s - - [%(time)s] "%(request_line)s" ' + \
             '%(resp_code)d %(body_len)d "%(referer)s" "%(user_agent)s"'
 
+    slow_request_threshold = None
+    slow_request_samples = 5
+
+    # seconds for shed clients to wait before retrying
+    retry_after = 1
+
     def __init__(self, *args, **kwargs):
         super(HTTPServer, self).__init__(*args, **kwargs)
+        self.overload_response = self.format_overload_response()
         self.access_log = logging.getLogger("feather.http.access")
         self.error_log = logging.getLogger("feather.http.errors")
+        self.slow_log = logging.getLogger("feather.http.slow")
+        self.in_flight = {}
+        self.slow_sampler = None
+
+    def format_overload_response(self):
+        "the complete 503 response sent to clients that get shed"
+        status, body = responses[503]
+        return ("HTTP/1.1 503 %s\r\nRetry-After: %d\r\n" +
+                "Content-Type: text/plain\r\nContent-Length: %d\r\n" +
+                "Connection: close\r\n\r\n%s") % (
+                status, self.retry_after, len(body), body)
+
+    def track_request(self, connection, request):
+        "start sampling a request's stack, in case it turns out to be slow"
+        self.in_flight[connection] = (
+                greenhouse.compat.getcurrent(), request, [])
+        if self.slow_sampler is None:
+            self.slow_sampler = greenhouse.schedule(self._sample_requests)
+
+    def untrack_request(self, connection):
+        "stop sampling a request, returning it and its stack samples"
+        glet, request, samples = self.in_flight.pop(
+                connection, (None, None, []))
+        return request, samples
+
+    def _sample_requests(self):
+        # only requests older than an interval get sampled at all, so this
+        # costs very little while nothing is slow. with nothing in flight it
+        # stops, and track_request() starts it again
+        interval = self.slow_request_threshold / self.slow_request_samples
+        while not self.shutting_down:
+            greenhouse.pause_for(interval)
+            if not self.in_flight:
+                break
+            cutoff = util.monotonic() - interval
+            for connection, (glet, request, samples) in \
+                    self.in_flight.items():
+                if (len(samples) >= self.slow_request_samples or
+                        connection.timings.handler_start > cutoff or
+                        glet.gr_frame is None):
+                    continue
+                samples.append("".join(traceback.format_stack(glet.gr_frame)))
+        self.slow_sampler = None
 
 
 class HTTPSServer(HTTPServer):
+    tls = True
+
     def __init__(self, *args, **kwargs):
         self.certfile = kwargs.pop('certfile', None)
         self.keyfile = kwargs.pop('keyfile', None)
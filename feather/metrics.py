@@ -0,0 +1,253 @@
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import logging
+import os
+import socket
+
+from greenhouse import io, scheduler
+
+from . import scoreboard
+
+
+__all__ = ["Totals", "render", "MetricsServer"]
+
+
+log = logging.getLogger("feather.metrics")
+
+# scoreboard fields that only ever go up, and their exported names
+COUNTERS = [
+    ("requests", "feather_requests_total",
+        "requests handled"),
+    ("bytes_received", "feather_received_bytes_total",
+        "bytes of requests read"),
+    ("bytes_sent", "feather_sent_bytes_total",
+        "bytes of responses sent"),
+    ("busy_time", "feather_busy_seconds_total",
+        "request-seconds spent handling requests"),
+    ("tls_handshakes", "feather_tls_handshakes_total",
+        "completed TLS handshakes"),
+    ("timeouts", "feather_request_timeouts_total",
+        "requests cut off by their deadlines"),
+    ("shed_connections", "feather_shed_connections_total",
+        "connections turned away at accept by load shedding"),
+    ("shed_requests", "feather_shed_requests_total",
+        "requests turned away unhandled by load shedding"),
+]
+
+# scoreboard fields that go up and down
+GAUGES = [
+    ("connections", "feather_connections",
+        "open client connections"),
+    ("active", "feather_active_requests",
+        "requests being handled"),
+]
+
+# scoreboard histograms, with the fields holding the sums of their samples
+HISTOGRAMS = [
+    ("handle_times", "handle_sum", "feather_request_duration_seconds",
+        "time from the start of handling a request to the end of its reply"),
+    ("lag_times", "lag_sum", "feather_scheduler_lag_seconds",
+        "how late workers' scheduler ticks were (with lag_threshold)"),
+]
+
+_SUMMED = [field for field, name, doc in COUNTERS] + ["responses"] + \
+        [field for histogram in HISTOGRAMS for field in histogram[:2]]
+
+
+def _accumulate(values, slot):
+    for field in _SUMMED:
+        value = slot.get(field)
+        if isinstance(value, tuple):
+            old = values.get(field, (0,) * len(value))
+            value = tuple(a + b for a, b in zip(old, value))
+        else:
+            value += values.get(field, 0)
+        values[field] = value
+
+
+class Totals(object):
+    """the summed counters of workers that have exited
+
+    the master adds a worker's slot here before clearing it, so that the
+    exported counters keep going up as workers come and go.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def add(self, slot):
+        _accumulate(self.values, slot)
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(slots, totals=None, restarts=0):
+    """the Prometheus text format page for a Monitor's workers
+
+    `slots` are the scoreboard slots of the current workers, `totals` a Totals
+    of the exited ones, and `restarts` how many workers have crashed and been
+    replaced.
+    """
+    values = dict(totals.values) if totals is not None else {}
+    for slot in slots:
+        _accumulate(values, slot)
+
+    lines = []
+
+    def metric(name, kind, doc, samples):
+        lines.append("# HELP %s %s" % (name, doc))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            if labels:
+                labels = "{%s}" % ",".join(
+                        '%s="%s"' % pair for pair in labels)
+            lines.append("%s%s%s %s" % (
+                name, suffix, labels or "", _number(value)))
+
+    metric("feather_workers", "gauge", "running worker processes",
+            [("", None, len(slots))])
+    metric("feather_worker_restarts_total", "counter",
+            "workers that crashed and were replaced", [("", None, restarts)])
+
+    for field, name, doc in COUNTERS:
+        metric(name, "counter", doc, [("", None, values.get(field, 0))])
+
+    responses = values.get("responses", (0,) * 5)
+    metric("feather_responses_total", "counter", "responses by status class",
+            [("", [("code", "%dxx" % (i + 1))], count)
+                for i, count in enumerate(responses)])
+
+    for field, name, doc in GAUGES:
+        metric(name, "gauge", doc,
+                [("", None, sum(slot.get(field) for slot in slots))])
+
+    bounds = list(scoreboard.LATENCY_BUCKETS) + [float('inf')]
+    for field, sum_field, name, doc in HISTOGRAMS:
+        counts = values.get(field, (0,) * len(bounds))
+        samples, seen = [], 0
+        for bound, count in zip(bounds, counts):
+            seen += count
+            samples.append(("_bucket", [("le", _number(bound))], seen))
+        samples.append(("_sum", None, values.get(sum_field, 0.0)))
+        samples.append(("_count", None, seen))
+        metric(name, "histogram", doc, samples)
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """a tiny HTTP listener that answers GET /metrics with `collect()`
+
+    it runs in the Monitor master's scheduler, separate from the server the
+    workers run, so scrapes never land on a worker. `address` is a (host,
+    port) pair or the path of a unix socket.
+
+    the port isn't shared (a second master can't bind it and split the
+    scrapes). a master started by SIGUSR2 gets the listening socket through
+    hand_over() instead.
+    """
+    MAX_REQUEST = 8192
+    TIMEOUT = 5.0
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+    environ_fd_name = "FEATHER_METRICS_FD"
+
+    def __init__(self, address, collect):
+        self.address = address
+        self.collect = collect
+        self.socket = None
+
+    def start(self):
+        family = socket.AF_INET
+        if isinstance(self.address, str):
+            family = socket.AF_UNIX
+
+        if self.environ_fd_name in os.environ:
+            # the listener of the master that exec'd us
+            fd = int(os.environ.pop(self.environ_fd_name))
+            sock = io.Socket(fromsock=socket.fromfd(
+                fd, family, socket.SOCK_STREAM))
+            os.close(fd)
+        else:
+            sock = io.Socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_UNIX:
+                try:
+                    os.unlink(self.address)
+                except EnvironmentError, exc:
+                    if exc.args[0] != errno.ENOENT:
+                        raise
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.address)
+            sock.listen(16)
+
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD,
+                fcntl.fcntl(sock.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.socket = sock
+        scheduler.schedule(self._serve)
+
+    def hand_over(self):
+        """keep the listener open across an exec, for start() to pick up
+
+        call this in the forked child that is about to exec a new master.
+        """
+        fd = self.socket.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+        os.environ[self.environ_fd_name] = str(fd)
+
+    def close(self):
+        "stop listening. a forked worker calls this to drop its copy"
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            sock.close()
+
+    def _serve(self):
+        sock = self.socket
+        while self.socket is sock:
+            try:
+                client, address = sock.accept()
+            except socket.error, exc:
+                if exc.args[0] in (errno.EBADF, errno.EINVAL):
+                    break
+                log.exception("metrics listener accept failed")
+                continue
+            scheduler.schedule(self._respond, args=(client,))
+
+    def _respond(self, client):
+        try:
+            client.settimeout(self.TIMEOUT)
+            data = ""
+            while "\r\n\r\n" not in data and "\n\n" not in data:
+                chunk = client.recv(1024)
+                if not chunk or len(data) > self.MAX_REQUEST:
+                    return
+                data += chunk
+
+            try:
+                method, path = data.split(None, 2)[:2]
+            except ValueError:
+                return
+            path = path.split("?", 1)[0]
+
+            if method not in ("GET", "HEAD"):
+                code, body = "405 Method Not Allowed", ""
+            elif path not in ("/", "/metrics"):
+                code, body = "404 Not Found", ""
+            else:
+                code, body = "200 OK", self.collect()
+
+            head = ("HTTP/1.0 %s\r\nContent-Type: %s\r\n" +
+                    "Content-Length: %d\r\nConnection: close\r\n\r\n") % (
+                    code, self.CONTENT_TYPE, len(body))
+            client.sendall(head + (body if method == "GET" else ""))
+        except socket.error:
+            pass
+        except Exception:
+            log.exception("failed to serve metrics")
+        finally:
+            client.close()
@@ -1,11 +1,14 @@
 from __future__ import absolute_import
 
+import cProfile
 import errno
 import fcntl
+import gc
 import grp
 import logging
 import os
 import pwd
+import random
 import shutil
 import signal
 import stat
@@ -16,18 +19,95 @@ import time
 
 from greenhouse import compat, io, scheduler, util as gutil
 
-from . import util
+from . import diagnostics, metrics, scoreboard, util
 
 
 master_log = logging.getLogger("feather.monitor.master")
+zygote_log = logging.getLogger("feather.monitor.zygote")
 worker_log = logging.getLogger("feather.monitor.worker")
 
 
+def _read_exactly(fd, size):
+    data = []
+    while size:
+        chunk = os.read(fd, size)
+        if not chunk:
+            raise EOFError()
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+
+class Zygote(object):
+    """the master's handle on a zygote process
+
+    a zygote is forked from the master and loads the app, and then forks
+    workers on request. each request is a (wid, scoreboard slot index) pair,
+    and the reply is the new worker's (wid, pid). with a wid of -1, the reply
+    means the zygote has finished loading.
+    """
+    message = struct.Struct("!iI")
+
+    def __init__(self, pid, commands, replies):
+        self.pid = pid
+        self.commands = commands
+        self.replies = io.File.fromfd(replies, 'rb')
+        self.lock = gutil.Lock()
+
+    def _reply(self):
+        data = self.replies.read(self.message.size)
+        if len(data) < self.message.size:
+            return None
+        return self.message.unpack(data)
+
+    def wait_loaded(self):
+        "wait for the zygote to load the app, returning whether it managed"
+        with self.lock:
+            return self._reply() is not None
+
+    def spawn(self, wid, index):
+        "have the zygote fork a worker, returning its pid (None on failure)"
+        with self.lock:
+            try:
+                os.write(self.commands, self.message.pack(wid, index))
+            except EnvironmentError, exc:
+                if exc.args[0] != errno.EPIPE:
+                    raise
+                return None
+            reply = self._reply()
+            return reply and reply[1] or None
+
+    def close(self):
+        # the zygote exits when it sees EOF
+        os.close(self.commands)
+        self.replies.close()
+
+
 class Monitor(object):
 
     WORKER_TIMEOUT = 2.0
     WORKER_CHECK_INTERVAL = WORKER_TIMEOUT / 2
 
+    # how long a hung worker gets to dump its stacks before it's killed
+    DUMP_GRACE_PERIOD = 2.0
+
+    # how often a worker's watchdog thread checks on it, and (with
+    # lag_threshold) how often its scheduler ticks to show it isn't blocked
+    WATCHDOG_INTERVAL = 0.5
+    LAG_TICK_INTERVAL = 0.1
+
+    SCOREBOARD_SLOTS = 256
+
+    # seconds a rolling reload waits for a new worker to become ready
+    RELOAD_READY_TIMEOUT = 60.0
+
+    RECYCLE_CHECK_INTERVAL = 5.0
+
+    # with idle_gc, how often a worker looks for a chance to collect, and the
+    # longest it will put off a due collection waiting for an idle moment
+    IDLE_GC_INTERVAL = 1.0
+    IDLE_GC_MAX_DELAY = 10.0
+
     ZOMBIE_CHECK_INTERVAL = 2.0
 
     DEFAULT_CLUSTER = 'default'
@@ -36,10 +116,17 @@ class Monitor(object):
     MASTER_PIDFILE = 'master.pid'
     WORKER_PIDFILE = 'worker%d.pid'
     LOCKFILE = '.lock'
-    HEALTHFILE = '.worker%d'
+    SCOREBOARD = 'scoreboard'
+    DUMP_DIR = 'dumps'
+    PROFILE_DIR = 'profiles'
 
     def __init__(self, server, worker_count, user=None, group=None,
-            control_dir=None, daemonize=False):
+            control_dir=None, daemonize=False, autoscaler=None,
+            reload_batch=0, reload_surge=0, max_requests=0, max_rss=0,
+            max_age=0, recycle_jitter=0.1, warmup=None, gc_threshold=None,
+            idle_gc=False, loader=None, zygote=False, cpu_affinity=None,
+            cpus=None, reserve_cpus=0, lag_threshold=None,
+            metrics_address=None):
         self.server = server
         self.count = worker_count
         self.control_dir = control_dir or os.path.join(
@@ -48,13 +135,47 @@ class Monitor(object):
         self.master_pid = None
         self.workers = {}
         self.rev_workers = {}
-        self.health_checks = {}
+        self.slots = {}
+        self.restarts = {}
+        self.scoreboard = None
+        self.health_checker = None
+        self.autoscaler = autoscaler
+        self.autoscale_checker = None
         self.do_not_revive = set()
         self.die_with_last_worker = False
         self.done = gutil.Event()
         self.zombie_checker = None
         self.readiness_notifier = None
-        self.original = True
+        self.ready_events = {}
+        self.reload_batch = reload_batch
+        self.reload_surge = reload_surge
+        self.replacing = False
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.max_age = max_age
+        self.recycle_jitter = recycle_jitter
+        self.recycle_factors = {}
+        self.recycle_checker = None
+        self.warmup = warmup
+        self.gc_threshold = gc_threshold
+        self.idle_gc = idle_gc
+        self.gc_due = None
+        self.loader = loader
+        self.zygote = zygote
+        self.zygote_process = None
+        self.is_zygote = False
+        if cpu_affinity not in (None, "cpu", "node"):
+            raise ValueError("cpu_affinity must be None, 'cpu' or 'node'")
+        self.cpu_affinity = cpu_affinity
+        self.cpus = cpus
+        self.reserve_cpus = reserve_cpus
+        self.cpu_groups = None
+        self.watchdog = None
+        self.lag_threshold = lag_threshold
+        self.profiler = None
+        self.metrics_address = metrics_address
+        self.metrics_server = None
+        self.exited_totals = metrics.Totals()
 
         # if the user or group name is not a valid one,
         # just let that exception propogate up
@@ -80,6 +201,8 @@ class Monitor(object):
     def log(self):
         if self.is_master:
             return master_log
+        if self.is_zygote:
+            return zygote_log
         return worker_log
 
     ##
@@ -216,7 +339,7 @@ class Monitor(object):
     def master_sigquit(self):
         # gracefully shutdown workers, then exit
         self.log.info("SIGQUIT received. gracefully shutting down")
-        self.do_not_revive.update(self.workers.values())
+        self.do_not_revive.update(self.rev_workers)
         self.die_with_last_worker = True
         if not self.workers:
             self.log.info("last worker done, exiting")
@@ -232,7 +355,7 @@ class Monitor(object):
             return
         self.log.info(
                 "SIGWINCH received. gracefully closing workers")
-        self.do_not_revive.update(self.workers.values())
+        self.do_not_revive.update(self.rev_workers)
         self.die_with_last_worker = False
         self.signal_workers(signal.SIGQUIT)
 
@@ -240,17 +363,35 @@ class Monitor(object):
         # gracefully shutdown and then re-fork workers
         self.log.info("SIGHUP received. bouncing workers")
 
-        if self.workers:
+        if self.replacing:
+            self.log.warn("workers are already being replaced, ignoring")
+            return
+
+        if self.zygote:
+            # load the app afresh, so the new workers get the new code
+            self.replacing = True
+            try:
+                if not self.replace_zygote():
+                    self.log.error("new zygote failed, not reloading")
+                    return
+            finally:
+                if self.is_master:
+                    self.replacing = False
+
+        if not self.workers:
+            self.fork_workers()
+        elif self.reload_batch:
             self.die_with_last_worker = False
-            self.signal_workers(signal.SIGQUIT, pids=self.workers.values())
+            self.rolling_reload()
         else:
-            self.fork_workers()
+            self.die_with_last_worker = False
+            self.signal_workers(signal.SIGQUIT, pids=self.workers.values())
 
     def master_sigint(self):
         # immediately kill workers, then exit
         self.log.info(
                 "SIGINT/TERM received. killing workers and exiting")
-        self.do_not_revive.update(self.workers.values())
+        self.do_not_revive.update(self.rev_workers)
         self.die_with_last_worker = True
         if not self.workers:
             self.log.info("last worker done, exiting")
@@ -260,18 +401,13 @@ class Monitor(object):
     def master_sigttin(self):
         # increment workers
         self.log.info("SIGTTIN received. incrementing worker count")
-        self.count += 1
-        self.fork_worker(self.count - 1)
+        self.add_worker()
 
     def master_sigttou(self):
         # decrement workers
         self.log.info(
                 "SIGTTOU received. gracefully closing one worker")
-
-        unlucky = self.workers[len(self.workers) - 1]
-        self.count -= 1
-        self.do_not_revive.add(unlucky)
-        os.kill(unlucky, signal.SIGQUIT)
+        self.remove_worker()
 
     def master_sigusr1(self):
         self.log.info("SIGUSR1 received")
@@ -313,6 +449,7 @@ class Monitor(object):
     def worker_sigquit(self):
         # gracefully shutdown
         self.log.info("SIGQUIT received. gracefully closing")
+        self.server.scoreboard_slot.set("state", scoreboard.STATE_STOPPING)
         self.server.shutdown()
         self.server.done.wait()
         self.done.set()
@@ -351,11 +488,51 @@ class Monitor(object):
         lockfile = self.control_path(self.LOCKFILE)
         self.ready_lockfd = os.open(lockfile, os.O_RDONLY)
 
+        self.scoreboard = scoreboard.Scoreboard(
+                self.control_path(self.SCOREBOARD, create=False),
+                self.SCOREBOARD_SLOTS)
+        if self.worker_uid is not None:
+            os.chown(self.scoreboard.path, self.worker_uid, os.getegid())
+
+        for name in (self.DUMP_DIR, self.PROFILE_DIR):
+            path = self.control_path(name, create=False)
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            if self.worker_uid is not None:
+                os.chown(path, self.worker_uid, os.getegid())
+
+        if self.cpu_affinity is not None:
+            self.plan_cpus()
+
+        if self.metrics_address is not None:
+            self.metrics_server = metrics.MetricsServer(
+                    self.metrics_address, self.collect_metrics)
+            self.metrics_server.start()
+
         self.apply_master_signals()
         self.server.worker_count = 1
         self.server.setup()
+        if self.server.reuse_port:
+            # every worker binds its own socket, so the master's only served
+            # to check that the address is usable. while it stays open the
+            # kernel hashes a share of the traffic to it, so it's closed
+            # before anything (workers or the zygote) is forked to inherit it
+            self.server.socket.close()
         self.zombie_monitor()
-
+        self.health_monitor()
+        if self.autoscaler is not None:
+            self.autoscale_monitor()
+        if self.max_requests or self.max_rss or self.max_age:
+            self.recycle_monitor()
+
+        if self.zygote:
+            if not util.set_child_subreaper():
+                raise RuntimeError("a zygote needs PR_SET_CHILD_SUBREAPER")
+            self.zygote_process = self.spawn_zygote()
+            if self.zygote_process is None:
+                raise RuntimeError("the zygote failed to load the app")
+        else:
+            self.preload()
         self.pre_worker_fork()
 
     def fork_worker(self, wid):
@@ -363,27 +540,144 @@ class Monitor(object):
             self.log.warn("tried to fork a worker from a worker")
             return True
 
-        tmpfname = self.control_path(self.HEALTHFILE % wid)
-        tmpfd = os.open(tmpfname, os.O_RDONLY)
-        if self.worker_uid is not None:
-            os.fchown(tmpfd, self.worker_uid, os.getegid())
+        slot = self.scoreboard.allocate()
+        if slot is None:
+            self.log.error("no free scoreboard slot for worker %d" % wid)
+            return False
+        slot.set("wid", wid)
+        slot.set("restarts", self.restarts.get(wid, 0))
+        slot.set("started", time.time())
+        slot.set("heartbeat", time.time())
+
+        if self.zygote:
+            if self.zygote_process is None:
+                pid = None
+            else:
+                pid = self.zygote_process.spawn(wid, slot.index)
+            if pid is None:
+                self.log.error("zygote failed to fork worker %d" % wid)
+                slot.clear()
+                return False
+            self.log.info("worker forked by zygote: %d" % pid)
+            self._worker_forked(wid, pid, slot)
+            return False
 
         pid = os.fork()
 
         if pid and self.is_master:
             self.log.info("worker forked: %d" % pid)
-            self._worker_forked(wid, pid, tmpfd, tmpfname)
+            self._worker_forked(wid, pid, slot)
             return False
 
         if self.workers is None:
             self.log.error("forked a worker from a worker, exiting")
             sys.exit(1)
 
-        self._worker_postfork(wid, pid, tmpfd)
+        self._worker_postfork(wid, pid, slot)
 
         self.server.serve()
         return True
 
+    def add_worker(self):
+        self.count += 1
+        return self.fork_worker(self.count - 1)
+
+    def remove_worker(self):
+        if self.count <= 1:
+            self.log.warn("not closing the last worker")
+            return
+        self.count -= 1
+        unlucky = self.workers.get(self.count)
+        if unlucky is not None:
+            self.do_not_revive.add(unlucky)
+            os.kill(unlucky, signal.SIGQUIT)
+
+    def retire_worker(self, pid):
+        self.do_not_revive.add(pid)
+        try:
+            os.kill(pid, signal.SIGQUIT)
+        except EnvironmentError, exc:
+            if exc.args[0] != errno.ESRCH:
+                raise
+
+    def wait_ready(self, pids):
+        "wait for new workers' readiness, returning whether they all made it"
+        deadline = time.time() + self.RELOAD_READY_TIMEOUT
+        for pid in pids:
+            event = self.ready_events.get(pid)
+            if event is None:
+                # already gone
+                return False
+            if event.wait(max(deadline - time.time(), 0)):
+                self.log.error("worker %d wasn't ready after %d seconds" %
+                        (pid, self.RELOAD_READY_TIMEOUT))
+                return False
+            if pid not in self.rev_workers:
+                self.log.error("new worker %d exited before it was ready" %
+                        pid)
+                return False
+        return True
+
+    def replace_workers(self, wids, surge):
+        """fork new workers for `wids`, retiring the ones they replace
+
+        the first `surge` of the new workers start alongside the old ones,
+        which are only retired once the new ones are ready. the rest of the
+        old workers are retired right away. returns whether every new worker
+        became ready (and False in the new workers themselves).
+        """
+        old = dict((wid, self.workers.get(wid)) for wid in wids)
+        surged = wids[:surge]
+
+        for wid in wids[surge:]:
+            if old[wid] is not None:
+                self.retire_worker(old[wid])
+
+        new = []
+        for wid in wids:
+            if self.fork_worker(wid):
+                # in the new worker, which has finished serving
+                return False
+            if self.workers.get(wid) not in (None, old[wid]):
+                new.append(self.workers[wid])
+
+        if not self.wait_ready(new):
+            return False
+
+        for wid in surged:
+            if old[wid] is not None:
+                self.retire_worker(old[wid])
+        return True
+
+    def rolling_reload(self):
+        """replace the workers `reload_batch` at a time
+
+        in each batch, up to `reload_surge` of the new workers are started
+        alongside the old ones they replace, which are only retired once the
+        new ones are ready. the rest of the batch's old workers are retired
+        right away. the next batch only starts once every new worker in this
+        one has reported ready, and if one fails to, the reload stops there
+        and the remaining old workers are left serving.
+        """
+        self.replacing = True
+        try:
+            wids = sorted(self.workers)
+            for i in xrange(0, len(wids), self.reload_batch):
+                if self.die_with_last_worker:
+                    # the cluster is shutting down
+                    return
+                batch = wids[i:i + self.reload_batch]
+                if not self.replace_workers(batch, self.reload_surge):
+                    if self.is_master:
+                        self.log.error("aborting rolling reload, %d of %d "
+                                "workers replaced" % (i, len(wids)))
+                    return
+
+            self.log.info("rolling reload complete")
+        finally:
+            if self.is_master:
+                self.replacing = False
+
     def fork_workers(self):
         self.log.info("forking %d workers" % (self.count,))
         for i in xrange(self.count):
@@ -391,24 +685,37 @@ class Monitor(object):
                 break
 
     def _post_worker_fork(self):
-        self.original = False
         self.readiness_notifier = scheduler.greenlet(self.notify_readiness)
         scheduler.schedule(self.readiness_notifier)
 
     def notify_readiness(self):
+        # runs for the life of the master, as every worker (not just the first
+        # generation) reports in when it's ready. the notify fifo is only
+        # written once, when the first generation is all ready
         pids = set(self.workers.values())
 
-        while pids:
+        while 1:
             pid = struct.unpack("!I", self.ready_r.read(4))[0]
             if not self.is_master:
                 self.log.warn(
                         "got a readiness notification in a worker, resending")
                 self.ready_w.write(struct.pack("!I", pid))
                 return
-            pids.remove(pid)
-            self.log.info("got readiness notification from %d, %d remaining" %
-                    (pid, len(pids)))
 
+            # a zygote's worker can be ready before we've heard its pid
+            self.ready_events.setdefault(pid, gutil.Event()).set()
+
+            if pids:
+                pids.discard(pid)
+                self.log.info(
+                        "got readiness notification from %d, %d remaining" %
+                        (pid, len(pids)))
+                if not pids:
+                    self.notify_cluster_ready()
+            else:
+                self.log.info("got readiness notification from %d" % pid)
+
+    def notify_cluster_ready(self):
         notify_fifo = self.control_path(self.NOTIFY_FIFO, create=False)
         self.log.info("notifying of readiness at %s" % notify_fifo)
         try:
@@ -424,22 +731,46 @@ class Monitor(object):
     def worker_forked(self, wid, pid):
         pass
 
-    def _worker_forked(self, wid, pid, tmpfd, tmpfname):
+    def _worker_forked(self, wid, pid, slot):
         self.workers[wid] = pid
         self.rev_workers[pid] = wid
-        self.log.info("starting health monitor for %d" % pid)
-        self.health_monitor(pid, tmpfd, tmpfname)
+        self.slots[pid] = slot
+        self.ready_events.setdefault(pid, gutil.Event())
+        # scale each worker's limits down a bit so they don't all hit them
+        # (and get replaced) at the same time
+        self.recycle_factors[pid] = 1 - random.uniform(0, self.recycle_jitter)
+        slot.set("pid", pid)
         self.worker_forked(wid, pid)
 
     def worker_postfork(self, wid, pid):
         pass
 
-    def _worker_postfork(self, wid, pid, tmpfd):
+    def _worker_postfork(self, wid, pid, slot):
         self.log.info("initializing worker")
 
+        slot.set("pid", os.getpid())
+        self.server.scoreboard_slot = slot
+
+        if self.cpu_groups:
+            cpus = self.worker_cpus(wid)
+            self.log.info("pinning to CPUs %s" % ",".join(map(str, cpus)))
+            try:
+                util.set_cpu_affinity(cpus)
+            except EnvironmentError, exc:
+                self.log.error("couldn't set CPU affinity: %s" % (exc,))
+
         with io.File(self.control_path(self.WORKER_PIDFILE % wid), 'w') as fp:
             fp.write(str(os.getpid()))
 
+        if self.readiness_notifier is not None:
+            scheduler.end(self.readiness_notifier)
+
+        scheduler.reset_poller()
+
+        # before dropping privileges, as with reuse_port this binds the
+        # worker's own socket, which may be on a privileged port
+        self.server.worker_setup()
+
         if self.worker_gid is not None:
             self.log.info("setting worker gid")
             os.setgid(self.worker_gid)
@@ -448,29 +779,66 @@ class Monitor(object):
             self.log.info("setting worker uid")
             os.setuid(self.worker_uid)
 
-        if self.readiness_notifier is not None:
-            scheduler.end(self.readiness_notifier)
-
-        scheduler.reset_poller()
-
-        if self.original:
-            scheduler.schedule(self.worker_inform_ready)
+        scheduler.schedule(self.worker_inform_ready)
+        scheduler.schedule(self.worker_mark_ready)
 
         self.clear_master_signals()
         self.apply_worker_signals()
 
-        for t in self.health_checks.values():
-            scheduler.end(t)
         self.workers = None
         self.rev_workers = None
-        self.health_checks = None
+        self.slots = None
+        self.ready_events = None
+        self.recycle_factors = None
+
+        if self.idle_gc:
+            gc.disable()
+            self.worker_gc_timer()
 
         self.log.info("starting health timer")
-        self.worker_health_timer(tmpfd)
-        self.zombie_checker.cancel()
+        self.worker_health_timer()
+        self.cancel_master_timers()
+        self.close_metrics()
+
+        interval = self.WATCHDOG_INTERVAL
+        if self.lag_threshold is not None:
+            # sample often enough to catch the stalls we're looking for
+            interval = min(interval, self.lag_threshold / 2)
+            slot.set("tick", time.time())
+            scheduler.schedule(self.worker_lag_ticker)
+
+        self.watchdog = diagnostics.Watchdog(
+                slot, self.control_path(self.DUMP_DIR, create=False),
+                interval, self.lag_threshold, self.LAG_TICK_INTERVAL)
+        self.watchdog.start()
 
         self.worker_postfork(wid, pid)
 
+    def cancel_master_timers(self):
+        self.zombie_checker.cancel()
+        self.health_checker.cancel()
+        if self.autoscale_checker is not None:
+            self.autoscale_checker.cancel()
+        if self.recycle_checker is not None:
+            self.recycle_checker.cancel()
+
+    def worker_lag_ticker(self):
+        # how late each wakeup is measures how long other greenlets keep the
+        # scheduler from getting back to us
+        slot = self.server.scoreboard_slot
+        while 1:
+            expected = time.time() + self.LAG_TICK_INTERVAL
+            scheduler.pause_for(self.LAG_TICK_INTERVAL)
+            now = time.time()
+            slot.set("tick", now)
+            lag = max(now - expected, 0)
+            slot.record_time(lag, "lag_times")
+            slot.incr("lag_sum", lag)
+
+    def worker_mark_ready(self):
+        self.server.ready.wait()
+        self.server.scoreboard_slot.set("state", scoreboard.STATE_READY)
+
     def worker_inform_ready(self):
         self.server.ready.wait()
         self.log.info("indicating readiness to master")
@@ -490,7 +858,7 @@ class Monitor(object):
         if not self.is_master:
             self.log.warn("tried signaling workers from a worker")
             return
-        pids = pids or self.workers.values()
+        pids = pids or self.rev_workers.keys()
         self.log.info("signaling all %d workers with %d" % (len(pids), signum))
 
         for pid in pids:
@@ -500,18 +868,43 @@ class Monitor(object):
         pass
 
     def _worker_exited(self, pid):
+        if (self.zygote_process is not None and
+                pid == self.zygote_process.pid):
+            self.zygote_exited()
+            return
+
         wid = self.rev_workers.pop(pid, None)
         if wid is None:
             # this could be another master that was created
             # by a SIGUSR2 handler and then killed off
             return
-        scheduler.end(self.health_checks.pop(pid))
-        del self.workers[wid]
+        slot = self.slots.pop(pid)
+        self.exited_totals.add(slot)
+        slot.clear()
+
+        # wake up a rolling reload that is waiting on this worker
+        self.ready_events.pop(pid).set()
+        self.recycle_factors.pop(pid, None)
+
+        # during a rolling reload a wid may briefly have two processes, the
+        # old one and its replacement. only the newest is in self.workers,
+        # so if that one dies first the old one takes the wid back
+        if self.workers.get(wid) == pid:
+            del self.workers[wid]
+            for other, other_wid in self.rev_workers.iteritems():
+                if other_wid == wid and other not in self.do_not_revive:
+                    self.workers[wid] = other
+                    break
+
         if pid in self.do_not_revive:
             self.do_not_revive.discard(pid)
+        elif wid in self.workers:
+            self.log.error("worker %d exited, leaving %d to serve wid %d" %
+                    (pid, self.workers[wid], wid))
         else:
             self.log.fatal("worker %d crashed, starting replacement" % pid)
             self.worker_crashed(wid, pid)
+            self.restarts[wid] = self.restarts.get(wid, 0) + 1
             if self.fork_worker(wid):
                 return
 
@@ -519,73 +912,417 @@ class Monitor(object):
             self.log.info("last worker done, exiting")
             self.done.set()
 
+    ##
+    ## Zygote
+    ##
+
+    def spawn_zygote(self):
+        "fork a zygote and wait for it to load, returning a Zygote or None"
+        commands_r, commands_w = os.pipe()
+        replies_r, replies_w = os.pipe()
+
+        pid = os.fork()
+        if not pid:
+            os.close(commands_w)
+            os.close(replies_r)
+            try:
+                self._zygote_main(commands_r, replies_w)
+            except Exception:
+                self.log.exception("zygote failed")
+            finally:
+                os._exit(1)
+
+        os.close(commands_r)
+        os.close(replies_w)
+        zygote = Zygote(pid, commands_w, replies_r)
+        self.log.info("started zygote %d, waiting for it to load" % pid)
+        if not zygote.wait_loaded():
+            zygote.close()
+            return None
+        return zygote
+
+    def replace_zygote(self):
+        zygote = self.spawn_zygote()
+        if zygote is None:
+            return False
+        old, self.zygote_process = self.zygote_process, zygote
+        if old is not None:
+            old.close()
+        return True
+
+    def zygote_exited(self):
+        self.log.error("zygote %d exited, starting another" %
+                self.zygote_process.pid)
+        self.zygote_process.close()
+        self.zygote_process = None
+        if self.die_with_last_worker:
+            return
+        self.replacing = True
+        try:
+            if not self.replace_zygote():
+                self.log.critical("replacement zygote failed, no workers "
+                        "can be started until a SIGHUP loads one")
+        finally:
+            if self.is_master:
+                self.replacing = False
+
+    def _zygote_main(self, commands, replies):
+        # mostly runs with plain blocking I/O. the workers it forks reset
+        # the rest of the greenhouse state they inherit
+        self.is_zygote = True
+        if self.zygote_process is not None:
+            # don't hold the previous zygote's pipes open
+            self.zygote_process.close()
+        self.cancel_master_timers()
+        self.close_metrics()
+        self.clear_master_signals()
+
+        if self.loader is not None:
+            self.loader()
+        self.preload()
+        os.write(replies, Zygote.message.pack(-1, 0))
+
+        while 1:
+            try:
+                wid, index = Zygote.message.unpack(
+                        _read_exactly(commands, Zygote.message.size))
+            except EOFError:
+                # the master has replaced or abandoned us
+                break
+
+            # fork twice, so the worker is orphaned and reparented to the
+            # master (a subreaper) which can then wait() on it directly
+            middle = os.fork()
+            if middle:
+                os.waitpid(middle, 0)
+                continue
+
+            try:
+                try:
+                    pid = os.fork()
+                except EnvironmentError:
+                    self.log.exception("failed to fork worker %d" % wid)
+                    pid = None
+                if pid == 0:
+                    os.close(commands)
+                    os.close(replies)
+                    self._zygote_worker(wid, index)
+                os.write(replies, Zygote.message.pack(wid, pid or 0))
+            finally:
+                os._exit(0)
+
+        os._exit(0)
+
+    def _zygote_worker(self, wid, index):
+        self.is_zygote = False
+        try:
+            self._worker_postfork(wid, 0, self.scoreboard.slot(index))
+            self.server.serve()
+            self.done.wait()
+        except Exception:
+            self.log.exception("worker failed")
+            os._exit(1)
+        os._exit(0)
+
+    ##
+    ## Metrics
+    ##
+
+    def collect_metrics(self):
+        return metrics.render(self.scoreboard.active(), self.exited_totals,
+                sum(self.restarts.itervalues()))
+
+    def close_metrics(self):
+        # the listener is the master's, children drop their copies
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+
     ##
     ## New Master Fork/Exec
     ##
 
     def new_master(self):
         server = self.server
-        os.environ[server.environ_fd_name] = str(server.socket.fileno())
+        if server.reuse_port:
+            # the new master can simply bind alongside us
+            os.environ.pop(server.environ_fd_name, None)
+        else:
+            os.environ[server.environ_fd_name] = str(server.socket.fileno())
 
         if not os.fork():
             self.log.info("in forked child, execing new master")
+            if self.metrics_server is not None:
+                self.metrics_server.hand_over()
             os.execvpe(sys.executable, [sys.executable] + sys.argv, os.environ)
 
     ##
     ## Health Checking
     ##
 
-    def health_monitor(self, pid, tmpfd, tmpfname):
-        checker = scheduler.greenlet(self.health_monitor_checker,
-                args=(pid, tmpfd, tmpfname))
-        scheduler.schedule(checker)
-        self.health_checks[pid] = checker
+    def health_monitor(self):
+        timer = gutil.Timer(
+                self.WORKER_CHECK_INTERVAL,
+                self.health_check)
+        timer.start()
+        self.health_checker = timer
 
-    def health_monitor_checker(self, pid, tmpfd, tmpfname):
-        now = time.time()
-        while 1:
-            scheduler.pause_until(now + self.WORKER_TIMEOUT)
+    def health_check(self):
+        # one pass over the scoreboard covers every worker
+        try:
             now = time.time()
-            checkin = os.fstat(tmpfd).st_ctime
-            if now - checkin > self.WORKER_TIMEOUT:
-                self.log.critical("health monitor check failed for %d" % pid)
-                try:
-                    os.kill(pid, signal.SIGKILL)
-                except EnvironmentError, exc:
-                    if exc.args[0] != errno.ESRCH:
-                        raise
-                    self._worker_exited(pid)
-                return
-            else:
-                self.log.debug("health monitor check passed for %d" % pid)
+            for pid, slot in self.slots.items():
+                if now - slot.get("heartbeat") > self.WORKER_TIMEOUT:
+                    self.health_check_failed(pid, slot)
+                else:
+                    self.log.debug("health monitor check passed for %d" % pid)
+        finally:
+            self.health_monitor()
 
-    def health_monitor_check(self, pid, tmpfd, tmpfname):
-        now = time.time()
-        checkin = os.fstat(tmpfd).st_ctime
-        if now - checkin > self.WORKER_TIMEOUT:
-            self.log.critical("health monitor check failed for %d" % pid)
-            try:
-                os.kill(pid, signal.SIGKILL)
-            except EnvironmentError, exc:
-                if exc.args[0] != errno.ESRCH:
-                    raise
+    def health_check_failed(self, pid, slot):
+        self.log.critical("health monitor check failed for %d, " % pid +
+                "requesting a stack dump before killing it")
+
+        # the worker's watchdog thread picks this up and writes the dump
+        slot.set("dump_requested", 1)
+
+        # don't fail it again before it gets killed and SIGCHLD handled
+        slot.set("heartbeat",
+                time.time() + self.DUMP_GRACE_PERIOD + self.WORKER_TIMEOUT)
+
+        gutil.Timer(self.DUMP_GRACE_PERIOD, self.kill_hung_worker,
+                args=(pid,)).start()
+
+    def kill_hung_worker(self, pid):
+        if not self.is_master or pid not in self.rev_workers:
+            return
+        self.log.critical("killing hung worker %d" % pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except EnvironmentError, exc:
+            if exc.args[0] != errno.ESRCH:
+                raise
             self._worker_exited(pid)
-        else:
-            self.log.debug("health monitor check passed for %d" % pid)
-            self.health_monitor(pid, tmpfd)
 
-    def worker_health_timer(self, tmpfd):
+    def worker_health_timer(self):
         timer = gutil.Timer(
                 self.WORKER_CHECK_INTERVAL,
-                self.worker_health_check,
-                args=(tmpfd,))
+                self.worker_health_check)
         timer.start()
         return timer
 
-    def worker_health_check(self, tmpfd):
-        self.log.debug("checking in with health monitor")
-        os.fchmod(tmpfd, 0644)
-        self.worker_health_timer(tmpfd)
+    def worker_health_check(self):
+        slot = self.server.scoreboard_slot
+        slot.set("heartbeat", time.time())
+
+        seconds = slot.get("profile_seconds")
+        if seconds:
+            slot.set("profile_seconds", 0)
+            if self.profiler is None:
+                self.start_profile(seconds)
+
+        self.worker_health_timer()
+
+    ##
+    ## Profiling
+    ##
+
+    def start_profile(self, seconds):
+        """profile the worker for `seconds`, then write the stats to a file
+
+        the profiler runs on the worker's thread, so it sees every greenlet
+        that runs in the meantime. the stats go to the control dir's profiles
+        directory as <pid>-<time>.pstats.
+        """
+        self.log.info("profiling for %s seconds" % seconds)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        gutil.Timer(seconds, self.finish_profile).start()
+
+    def finish_profile(self):
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+
+        path = os.path.join(self.control_path(self.PROFILE_DIR, create=False),
+                "%d-%d.pstats" % (os.getpid(), time.time()))
+        # featherctl watches for the file, so don't let it see a partial one
+        profiler.dump_stats(path + ".tmp")
+        os.rename(path + ".tmp", path)
+        self.log.info("wrote profile to %s" % path)
+
+    ##
+    ## CPU Placement
+    ##
+
+    def plan_cpus(self):
+        # workers alternate between NUMA nodes, so each node gets a fair
+        # share, and within a node they take the node's CPUs in turn
+        nodes = util.cpu_nodes()
+        allowed = set(self.cpus or [cpu for node in nodes for cpu in node])
+
+        # the lowest numbered CPUs tend to get the most interrupt handling,
+        # so those are the ones left to the master and the rest of the OS
+        reserved = sorted(allowed)[:self.reserve_cpus]
+        allowed.difference_update(reserved)
+
+        groups = [[cpu for cpu in node if cpu in allowed] for node in nodes]
+        self.cpu_groups = [group for group in groups if group]
+        if not self.cpu_groups:
+            self.log.error("no CPUs left for the workers, not pinning them")
+            return
+
+        if reserved:
+            try:
+                util.set_cpu_affinity(reserved)
+            except EnvironmentError, exc:
+                self.log.error("couldn't set CPU affinity: %s" % (exc,))
+
+    def worker_cpus(self, wid):
+        "the CPUs a worker should be pinned to, based on its wid"
+        group = self.cpu_groups[wid % len(self.cpu_groups)]
+        if self.cpu_affinity == "node":
+            return group
+        return [group[(wid // len(self.cpu_groups)) % len(group)]]
+
+    ##
+    ## Copy-on-Write Friendliness
+    ##
+
+    def preload(self):
+        # everything the master has in memory when it forks is shared with
+        # the workers until one of them writes to it. so get the app into its
+        # steady state first, then collect the garbage that produced so the
+        # workers don't each collect (and so copy) it themselves
+        if self.warmup is not None:
+            self.log.info("warming up")
+            self.warmup()
+
+        self.log.info("collected %d objects before forking" % gc.collect())
+
+        if self.gc_threshold is not None:
+            gc.set_threshold(*self.gc_threshold)
+
+    def worker_gc_timer(self):
+        timer = gutil.Timer(
+                self.IDLE_GC_INTERVAL,
+                self.worker_gc_check)
+        timer.start()
+        return timer
+
+    def worker_gc_check(self):
+        # with the collector disabled, run the collections it would have run,
+        # but wait for a moment with no requests in progress (up to a point)
+        try:
+            generation = -1
+            for i, (count, threshold) in enumerate(
+                    zip(gc.get_count(), gc.get_threshold())):
+                if threshold and count >= threshold:
+                    generation = i
+            if generation < 0:
+                self.gc_due = None
+                return
+
+            now = time.time()
+            if self.gc_due is None:
+                self.gc_due = now
+
+            if (not self.server.scoreboard_slot.get("active") or
+                    now - self.gc_due >= self.IDLE_GC_MAX_DELAY):
+                gc.collect(generation)
+                self.gc_due = None
+        finally:
+            self.worker_gc_timer()
+
+    ##
+    ## Autoscaling
+    ##
+
+    def autoscale_monitor(self):
+        timer = gutil.Timer(
+                self.autoscaler.interval,
+                self.autoscale_check)
+        timer.start()
+        self.autoscale_checker = timer
+
+    def autoscale_check(self):
+        try:
+            if self.die_with_last_worker:
+                # shutting down
+                return
+            desired = self.autoscaler.decide(self.count, self.slots.values())
+            if desired != self.count:
+                self.log.info("autoscaling from %d to %d workers (load %s)" %
+                        (self.count, desired, self.autoscaler.load))
+            while self.count < desired:
+                if self.add_worker():
+                    # we're in a new worker
+                    return
+            while self.count > desired:
+                self.remove_worker()
+        finally:
+            if self.is_master:
+                self.autoscale_monitor()
+
+    ##
+    ## Worker Recycling
+    ##
+
+    def recycle_monitor(self):
+        timer = gutil.Timer(
+                self.RECYCLE_CHECK_INTERVAL,
+                self.recycle_check)
+        timer.start()
+        self.recycle_checker = timer
+
+    def recycle_candidate(self):
+        "a (pid, reason) pair for a worker that is past a limit, or None"
+        now = time.time()
+        for pid, slot in self.slots.items():
+            if (pid in self.do_not_revive or
+                    self.workers.get(self.rev_workers[pid]) != pid or
+                    slot.get("state") != scoreboard.STATE_READY):
+                continue
+            factor = self.recycle_factors[pid]
+
+            requests = slot.get("requests")
+            if self.max_requests and requests >= self.max_requests * factor:
+                return pid, "handled %d requests" % requests
+
+            age = now - slot.get("started")
+            if self.max_age and age >= self.max_age * factor:
+                return pid, "%d seconds old" % age
+
+            if self.max_rss:
+                rss = util.rss(pid)
+                if rss is not None and rss >= self.max_rss * factor:
+                    return pid, "RSS is %d bytes" % rss
+        return None
+
+    def recycle_check(self):
+        # replaces one worker at a time, each replacement ready before the
+        # old worker is retired, so the next check waits for it to finish
+        try:
+            if self.replacing or self.die_with_last_worker:
+                return
+            candidate = self.recycle_candidate()
+            if candidate is None:
+                return
+            pid, reason = candidate
+            self.log.info("recycling worker %d, %s" % (pid, reason))
+
+            self.replacing = True
+            try:
+                replaced = self.replace_workers([self.rev_workers[pid]], 1)
+            finally:
+                if self.is_master:
+                    self.replacing = False
+
+            if not replaced and self.is_master:
+                self.log.error("replacement for worker %d failed, "
+                        "leaving it running" % pid)
+        finally:
+            if self.is_master:
+                self.recycle_monitor()
 
     ##
     ## Extra Zombie Cleanup
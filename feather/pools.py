@@ -0,0 +1,328 @@
+import collections
+import cPickle
+import errno
+import fcntl
+import os
+import Queue
+import resource
+import signal
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import greenhouse
+from feather import util
+
+
+__all__ = ["PoolFull", "PoolTimeout", "ThreadPool", "ProcessPool"]
+
+
+class PoolFull(Exception):
+    "raised when a pool already has as many calls queued as it will accept"
+
+
+class PoolTimeout(Exception):
+    "raised when a pool call doesn't finish within its timeout"
+
+
+class _Job(object):
+    __slots__ = ["func", "args", "kwargs", "result", "exc_info", "done"]
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = self.exc_info = None
+        self.done = greenhouse.Event()
+
+
+class ThreadPool(object):
+    """a bounded pool of OS threads for running calls that block the process
+
+    greenhouse schedules every coroutine in a process on one thread, so a call
+    that blocks without going through greenhouse (a C database driver, for
+    instance) stops every connection in the worker. run() hands such a call to
+    one of `size` threads and blocks only the calling coroutine until it
+    finishes, while the rest of the process keeps doing I/O.
+
+    queue_depth limits how many calls may wait for a free thread. once it is
+    reached run() raises PoolFull instead of queueing more. 0 means no limit.
+
+    threads are started on first use and again after a fork, so a pool can be
+    created before a Monitor forks its workers. the threads must be real ones,
+    so don't use this with greenhouse's "thread"/"threading" emulation patched.
+    """
+    def __init__(self, size=10, queue_depth=100):
+        self.size = size
+        self.queue_depth = queue_depth
+        self._pid = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._jobs = Queue.Queue()
+        self._finished = collections.deque()
+
+        self._wake_r, self._wake_w = os.pipe()
+        flags = fcntl.fcntl(self._wake_r, fcntl.F_GETFL)
+        fcntl.fcntl(self._wake_r, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        for i in xrange(self.size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+        greenhouse.schedule(self._dispatch)
+
+    def _work(self):
+        # runs in the pool threads, so it must not touch greenhouse objects
+        while 1:
+            job = self._jobs.get()
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            except Exception:
+                job.exc_info = sys.exc_info()
+            self._finished.append(job)
+            os.write(self._wake_w, '\x00')
+
+    def _dispatch(self):
+        # runs in the greenhouse thread, waking coroutines as jobs complete
+        pid = self._pid
+        while self._pid == pid:
+            greenhouse.wait_fds([(self._wake_r, 1)])
+            try:
+                os.read(self._wake_r, 4096)
+            except EnvironmentError, exc:
+                if exc.args[0] not in (errno.EAGAIN, errno.EINTR):
+                    raise
+            while self._finished:
+                self._finished.popleft().done.set()
+
+    @property
+    def queued(self):
+        "the number of calls waiting for a free thread"
+        if self._pid != os.getpid():
+            return 0
+        return self._jobs.qsize()
+
+    @property
+    def full(self):
+        "whether run() would raise PoolFull right now"
+        return bool(self.queue_depth) and self.queued >= self.queue_depth
+
+    def run(self, func, *args, **kwargs):
+        """run func(*args, **kwargs) in a pool thread and return its result
+
+        blocks the calling coroutine (but not the process) until the call has
+        finished. an exception raised by func is re-raised here.
+        """
+        if self._pid != os.getpid():
+            self._start()
+
+        if self.queue_depth and self._jobs.qsize() >= self.queue_depth:
+            raise PoolFull()
+
+        job = _Job(func, args, kwargs)
+        self._jobs.put(job)
+        job.done.wait()
+
+        if job.exc_info is not None:
+            klass, exc, tb = job.exc_info
+            job.exc_info = None
+            raise klass, exc, tb
+        return job.result
+
+
+def _read_exactly(fd, size):
+    data = []
+    while size:
+        chunk = os.read(fd, size)
+        if not chunk:
+            raise EOFError()
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+
+def _helper_main(req_r, resp_w):
+    # the body of a ProcessPool helper. it only uses plain blocking I/O, the
+    # greenhouse state it inherited from the worker is never run again
+    for signum in (signal.SIGQUIT, signal.SIGTERM, signal.SIGHUP,
+            signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    low, high = sorted((req_r, resp_w))
+    util.closerange(3, low)
+    util.closerange(low + 1, high)
+    util.closerange(high + 1, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+
+    while 1:
+        try:
+            size, = struct.unpack("!I", _read_exactly(req_r, 4))
+            func, args, kwargs = cPickle.loads(_read_exactly(req_r, size))
+        except EOFError:
+            # the worker that owns us has gone away
+            break
+
+        try:
+            response = (True, func(*args, **kwargs))
+        except Exception, exc:
+            response = (False, exc, traceback.format_exc())
+
+        try:
+            data = cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL)
+        except Exception, exc:
+            data = cPickle.dumps((False, RuntimeError(
+                "unpicklable offload result: %r" % (exc,)), ""),
+                cPickle.HIGHEST_PROTOCOL)
+
+        try:
+            os.write(resp_w, struct.pack("!I", len(data)))
+            while data:
+                data = data[os.write(resp_w, data):]
+        except EnvironmentError:
+            break
+
+    os._exit(0)
+
+
+class _Helper(object):
+    def __init__(self):
+        req_r, req_w = os.pipe()
+        resp_r, resp_w = os.pipe()
+
+        self.pid = os.fork()
+        if not self.pid:
+            os.close(req_w)
+            os.close(resp_r)
+            try:
+                _helper_main(req_r, resp_w)
+            finally:
+                os._exit(1)
+
+        os.close(req_r)
+        os.close(resp_w)
+        self.requests = greenhouse.File.fromfd(req_w, 'wb')
+        self.responses = resp_r
+        fcntl.fcntl(resp_r, fcntl.F_SETFL,
+                fcntl.fcntl(resp_r, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def _read(self, size, deadline):
+        data = []
+        while size:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not greenhouse.wait_fds(
+                        [(self.responses, 1)], timeout=remaining):
+                    raise PoolTimeout()
+            try:
+                chunk = os.read(self.responses, size)
+            except EnvironmentError, exc:
+                if exc.args[0] not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                if deadline is None:
+                    greenhouse.wait_fds([(self.responses, 1)])
+                continue
+            if not chunk:
+                raise EOFError()
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def call(self, data, deadline):
+        self.requests.write(struct.pack("!I", len(data)) + data)
+
+        size, = struct.unpack("!I", self._read(4, deadline))
+        return cPickle.loads(self._read(size, deadline))
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except EnvironmentError, exc:
+            if exc.args[0] not in (errno.ESRCH, errno.ECHILD):
+                raise
+        self.requests.close()
+        os.close(self.responses)
+
+
+class ProcessPool(object):
+    """a pool of helper processes for CPU-bound calls
+
+    a worker runs all of its connections in one thread, so a handler doing a
+    lot of computation holds up every other request in the process. run()
+    sends a picklable callable and its arguments to one of `size` helper
+    processes and blocks only the calling coroutine until the result comes
+    back over a pipe.
+
+    queue_depth limits how many calls may wait for an idle helper, after which
+    run() raises PoolFull (0 means no limit). timeout, if provided, limits how
+    long a call may take, including its time in the queue. a call that runs
+    past it raises PoolTimeout and its helper is killed and replaced.
+
+    helpers are forked on first use and again after a fork, so each Monitor
+    worker gets its own.
+    """
+    def __init__(self, size=2, queue_depth=100, timeout=None):
+        self.size = size
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._pid = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._idle = greenhouse.Queue()
+        self._waiting = 0
+        for i in xrange(self.size):
+            self._idle.put(_Helper())
+
+    def run(self, func, *args, **kwargs):
+        "run func(*args, **kwargs) in a helper process and return its result"
+        return self.apply(func, args, kwargs)
+
+    def apply(self, func, args=(), kwargs=None, timeout=None):
+        """run func(*args, **kwargs) in a helper process and return its result
+
+        an exception raised by func is re-raised here, and `timeout` overrides
+        the pool's default timeout.
+        """
+        if self._pid != os.getpid():
+            self._start()
+
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+
+        data = cPickle.dumps((func, args, kwargs or {}),
+                cPickle.HIGHEST_PROTOCOL)
+
+        if (self._idle.empty() and self.queue_depth
+                and self._waiting >= self.queue_depth):
+            raise PoolFull()
+
+        self._waiting += 1
+        try:
+            helper = self._idle.get(timeout=timeout)
+        except Queue.Empty:
+            raise PoolTimeout()
+        finally:
+            self._waiting -= 1
+
+        try:
+            response = helper.call(data, deadline)
+        except:
+            # the helper is busy with an abandoned call or is dead,
+            # either way it can't be trusted with another one
+            helper.kill()
+            self._idle.put(_Helper())
+            raise
+
+        self._idle.put(helper)
+
+        if response[0]:
+            return response[1]
+        exc = response[1]
+        exc.offload_traceback = response[2]
+        raise exc
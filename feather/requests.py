@@ -26,12 +26,16 @@ class RequestHandler(object):
     socket.sendall() call, so keep that in mind -- for instance you may want to
     chunk up large files yourself rather than just returning the file object,
     since the lines may be shorter than a good chunk size.
+
+    the timings attribute is the connection's RequestTimings for the request
+    being handled, with the phases up to handler_start already filled in.
     """
     def __init__(self, client_address, server_address, connection):
         self.client_address = client_address
         self.server_address = server_address
         self.connection = connection
         self.server = connection.server
+        self.timings = getattr(connection, "timings", None)
 
     def handle(self, request):
         raise NotImplementedError()
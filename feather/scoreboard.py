@@ -0,0 +1,209 @@
+import bisect
+import mmap
+import os
+import struct
+
+
+__all__ = ["Scoreboard", "Slot", "percentile"]
+
+
+MAGIC = "feathsb1"
+
+STATE_FREE = 0
+STATE_STARTING = 1
+STATE_READY = 2
+STATE_STOPPING = 3
+
+STATE_NAMES = {
+    STATE_FREE: "free",
+    STATE_STARTING: "starting",
+    STATE_READY: "ready",
+    STATE_STOPPING: "stopping",
+}
+
+# upper bounds (in seconds) of the buckets of the request phase and scheduler
+# lag histograms. there is one more bucket after these for anything slower
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+
+# the layout of each worker's slot. a field with a repeat count in its format
+# is an array, read as a tuple and updated an element at a time
+FIELDS = [
+    ("pid", "I"),
+    ("wid", "i"),
+    ("state", "B"),
+    ("started", "d"),
+    ("heartbeat", "d"),
+    ("dump_requested", "B"),
+    # set (by featherctl profile) to ask the worker for a profile this long
+    ("profile_seconds", "d"),
+    ("restarts", "I"),
+    ("connections", "I"),
+    ("active", "I"),
+    ("requests", "Q"),
+    ("bytes_received", "Q"),
+    ("bytes_sent", "Q"),
+    ("busy_time", "d"),
+    ("tls_handshakes", "Q"),
+    ("timeouts", "Q"),
+    ("shed_connections", "Q"),
+    ("shed_requests", "Q"),
+    # by status class, 1xx through 5xx
+    ("responses", "5Q"),
+    ("handle_times", "%dQ" % (len(LATENCY_BUCKETS) + 1)),
+    ("handle_sum", "d"),
+    ("queue_times", "%dQ" % (len(LATENCY_BUCKETS) + 1)),
+    ("read_times", "%dQ" % (len(LATENCY_BUCKETS) + 1)),
+    ("app_times", "%dQ" % (len(LATENCY_BUCKETS) + 1)),
+    ("write_times", "%dQ" % (len(LATENCY_BUCKETS) + 1)),
+    ("tick", "d"),
+    ("lag_times", "%dQ" % (len(LATENCY_BUCKETS) + 1)),
+    ("lag_sum", "d"),
+]
+
+HEADER = struct.Struct("=8sIII")
+
+
+def _layout(fields):
+    layout, offset = {}, 0
+    for name, fmt in fields:
+        count = int(fmt[:-1] or 1)
+        element = struct.Struct("=" + fmt[-1])
+        layout[name] = (element, offset, count)
+        offset += element.size * count
+    return layout, offset
+
+LAYOUT, SLOT_SIZE = _layout(FIELDS)
+
+
+def bucket(seconds):
+    "the index of the histogram bucket for a duration"
+    return bisect.bisect_left(LATENCY_BUCKETS, seconds)
+
+
+def percentile(counts, fraction):
+    """estimate a percentile from histogram bucket counts
+
+    returns the upper bound of the bucket the percentile falls in (or
+    float('inf') for the last one), or None if the counts are all zero.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= total * fraction:
+            break
+    if index < len(LATENCY_BUCKETS):
+        return LATENCY_BUCKETS[index]
+    return float('inf')
+
+
+class Slot(object):
+    """one worker's fixed-size record in a Scoreboard
+
+    reads and writes go straight to shared memory, so the worker can keep its
+    slot up to date without any system calls and the master (or featherctl)
+    can read it at any time.
+    """
+    __slots__ = ["index", "_mmap", "_offset"]
+
+    def __init__(self, mm, index):
+        self.index = index
+        self._mmap = mm
+        self._offset = HEADER.size + index * SLOT_SIZE
+
+    def get(self, name):
+        element, offset, count = LAYOUT[name]
+        offset += self._offset
+        if count == 1:
+            return element.unpack_from(self._mmap, offset)[0]
+        return struct.unpack_from("=%d%s" % (count, element.format[-1]),
+                self._mmap, offset)
+
+    def set(self, name, value, index=0):
+        element, offset, count = LAYOUT[name]
+        element.pack_into(self._mmap,
+                self._offset + offset + index * element.size, value)
+
+    def incr(self, name, amount=1, index=0):
+        element, offset, count = LAYOUT[name]
+        offset += self._offset + index * element.size
+        element.pack_into(self._mmap, offset,
+                element.unpack_from(self._mmap, offset)[0] + amount)
+
+    def record_time(self, seconds, field="handle_times"):
+        "count a duration in one of the histograms (handle time by default)"
+        self.incr(field, 1, bucket(seconds))
+
+    def clear(self):
+        self._mmap[self._offset:self._offset + SLOT_SIZE] = "\x00" * SLOT_SIZE
+
+    def snapshot(self):
+        "all of the slot's fields, as a dict"
+        return dict((name, self.get(name)) for name, fmt in FIELDS)
+
+
+class Scoreboard(object):
+    """a memory-mapped file with a slot for each worker process
+
+    the master creates it before forking, so the mapping is shared with every
+    worker. other processes (featherctl) can open it by path to read it.
+    """
+    def __init__(self, path, slots=None, readonly=False):
+        """create a scoreboard with `slots` slots, or open an existing one
+
+        opening an existing scoreboard raises ValueError if it was created by
+        a feather version with a different slot layout. with `readonly` it is
+        mapped read-only, which is all a monitoring tool needs.
+        """
+        self.path = path
+        if slots is None:
+            fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR)
+            try:
+                magic, slot_size, slots, self.master_pid = HEADER.unpack(
+                        os.read(fd, HEADER.size))
+                if magic != MAGIC or slot_size != SLOT_SIZE:
+                    raise ValueError(
+                            "%s is not a compatible scoreboard" % path)
+                self.mmap = mmap.mmap(fd, HEADER.size + slots * SLOT_SIZE,
+                        access=mmap.ACCESS_READ if readonly
+                            else mmap.ACCESS_WRITE)
+            finally:
+                os.close(fd)
+        else:
+            self.master_pid = os.getpid()
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                os.ftruncate(fd, HEADER.size + slots * SLOT_SIZE)
+                self.mmap = mmap.mmap(fd, HEADER.size + slots * SLOT_SIZE)
+            finally:
+                os.close(fd)
+            HEADER.pack_into(
+                    self.mmap, 0, MAGIC, SLOT_SIZE, slots, self.master_pid)
+        self.size = slots
+
+    def __iter__(self):
+        for index in xrange(self.size):
+            yield Slot(self.mmap, index)
+
+    def active(self):
+        "the slots that currently belong to a worker"
+        return [slot for slot in self
+                if slot.get("state") != STATE_FREE]
+
+    def slot(self, index):
+        return Slot(self.mmap, index)
+
+    def allocate(self):
+        "claim and return a free slot, or None if they are all in use"
+        for slot in self:
+            if slot.get("state") == STATE_FREE:
+                slot.clear()
+                slot.set("state", STATE_STARTING)
+                return slot
+        return None
+
+    def close(self):
+        self.mmap.close()
@@ -2,12 +2,41 @@ import errno
 import os
 import socket
 import subprocess
+import sys
 
 import greenhouse
 from feather import connections, util
 
 
-__all__ = ["BaseServer", "TCPServer", "UDPServer"]
+__all__ = ["BaseServer", "TCPServer", "UDPServer", "DelayShedder"]
+
+
+# not exposed by the socket module in python 2, this is linux's value
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+class DelayShedder(object):
+    """a CoDel-style admission policy driven by queueing delay
+
+    it is shown the delay of each unit of work (how long it waited to be
+    started) and decides whether to take it on. while delays keep dipping
+    under `target`, the queue is draining and everything is admitted. once
+    they have stayed at or above target for a whole `interval`, a standing
+    queue has built up and anything that waited target or longer is shed,
+    until work starts getting through in under target again.
+    """
+    def __init__(self, target, interval):
+        self.target = target
+        self.interval = interval
+        self.below_target = util.monotonic()
+
+    def admit(self, delay, now=None):
+        if now is None:
+            now = util.monotonic()
+        if delay < self.target:
+            self.below_target = now
+            return True
+        return now - self.below_target < self.interval
 
 
 class BaseServer(object):
@@ -19,8 +48,15 @@ class BaseServer(object):
     socket_protocol = socket.SOL_IP
     worker_count = 1
     allow_reuse_address = True
+    reuse_port = False
     environ_fd_name = "FEATHER_LISTEN_FD"
 
+    # a feather.scoreboard.Slot to keep stats in, set by Monitor in workers
+    scoreboard_slot = None
+
+    # whether accepted connections have been through a TLS handshake
+    tls = False
+
     def __init__(self, address, hostname=None, daemonize=False):
         self.host, self.port = address
         self.name = hostname or self.host
@@ -36,11 +72,13 @@ class BaseServer(object):
                 self.socket_protocol)
         if self.allow_reuse_address:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 
     def pickup_environ_socket(self):
         fd = int(os.environ[self.environ_fd_name])
-        self.socket = greenhouse.Socket(
-                fromsock=socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM))
+        self.socket = greenhouse.Socket(fromsock=socket.fromfd(
+                fd, self.address_family, self.socket_type))
 
     def setup(self):
         self.pre_fork_setup()
@@ -59,11 +97,24 @@ class BaseServer(object):
     def post_fork_setup(self):
         pass
 
+    def worker_setup(self):
+        """called by a Monitor in each worker process just after it is forked
+
+        with reuse_port set, this gives the worker its own socket bound to the
+        server address, so the kernel spreads connections or datagrams across
+        the workers instead of all of them contending for the one socket.
+        """
+        if self.reuse_port:
+            self.socket.close()
+            self.init_socket()
+            self.socket.bind((self.host, self.port))
+
     def fork_children(self):
         for i in xrange(self.worker_count - 1):
             if not os.fork():
                 # children will need their own epoll object
                 greenhouse.reset_poller()
+                self.worker_setup()
                 break # no grandchildren
 
     def serve(self):
@@ -90,22 +141,144 @@ class TCPServer(BaseServer):
       server can't accept them fast enough. its default is the maximum allowed
       by the system (socket.SOMAXCONN).
 
+    * request_timeout is the number of seconds a request gets, from the start
+      of its handler to the end of its response. when it runs out, a
+      connections.RequestTimeout is raised in the connection's coroutine and
+      the connection is closed after it. the default of None means no limit.
+      a handler can change its request's deadline with
+      connection.set_deadline().
+
+    * max_connections and max_in_flight limit the open connections and the
+      requests being handled at once (per worker process). over either limit,
+      the server sheds new work: it sends overload_response, if there is one,
+      in a single write and closes the connection. shed connections and
+      requests are counted in the scoreboard.
+
+    * queue_delay_target turns on adaptive shedding (see DelayShedder) with
+      that target in seconds, over queue_delay_interval. the delay measured
+      is how long a newly accepted connection waited for its coroutine to be
+      scheduled, and requests are shed like those over max_in_flight.
+      only the first request on each connection has such a delay, so later
+      requests on keep-alive connections are never shed by this. to bound
+      those as well, set max_in_flight too.
+
     the cleanup() method may also be overridden to add extra behavior at the
     server's exit
     """
     socket_type = socket.SOCK_STREAM
     listen_backlog = socket.SOMAXCONN
     connection_handler = connections.TCPConnection
+    request_timeout = None
+    max_connections = None
+    max_in_flight = None
+    queue_delay_target = None
+    queue_delay_interval = 0.1
+
+    # preformatted bytes to send to shed clients, or None to just close
+    overload_response = None
+
+    # how long to keep reading from a shed client before closing on it, so
+    # the close doesn't reset the connection before the response arrives
+    shed_linger = 0.5
+
+    # how often to look for requests that have run past their deadlines
+    deadline_check_interval = 0.1
 
     def __init__(self, *args, **kwargs):
         super(TCPServer, self).__init__(*args, **kwargs)
         self.done = greenhouse.Event()
         self.connections = greenhouse.Counter()
+        self.deadlines = {}
+        self.deadline_enforcer = None
+        self.open_connections = 0
+        self.delay_shedder = None
+
+    def admit_connection(self):
+        "whether to take on a newly accepted connection"
+        return (self.max_connections is None or
+                self.open_connections < self.max_connections)
+
+    def admit_request(self, connection):
+        "whether to handle a request that has just been read"
+        if (self.max_in_flight is not None and
+                self.connections.count >= self.max_in_flight):
+            return False
+
+        delay = connection.timings.queue
+        if self.queue_delay_target is None or delay is None:
+            return True
+        if self.delay_shedder is None:
+            self.delay_shedder = DelayShedder(
+                    self.queue_delay_target, self.queue_delay_interval)
+        return self.delay_shedder.admit(delay)
+
+    def shed(self, sock, kind):
+        """turn away a client with overload_response, then close it
+
+        `kind` is "connections" or "requests", for the scoreboard counts
+        """
+        slot = self.scoreboard_slot
+        if slot is not None:
+            slot.incr("shed_" + kind)
+        greenhouse.schedule(self._shed, args=(sock,))
+
+    def _shed(self, sock):
+        try:
+            if self.overload_response is not None:
+                sock.sendall(self.overload_response)
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(self.shed_linger)
+            received = 0
+            while received < 65536:
+                data = sock.recv(8192)
+                if not data:
+                    break
+                received += len(data)
+        except socket.error:
+            pass
+        finally:
+            try:
+                os.close(sock.fileno())
+                sock.close()
+            except EnvironmentError, exc:
+                if exc.args[0] != errno.EBADF:
+                    raise
+
+    def watch_deadline(self, connection):
+        "enforce a connection's deadline (its `deadline` attribute)"
+        self.deadlines[connection] = connection.greenlet
+        if self.deadline_enforcer is None:
+            self.deadline_enforcer = greenhouse.schedule(
+                    self._enforce_deadlines)
+
+    def unwatch_deadline(self, connection):
+        self.deadlines.pop(connection, None)
+
+    def _enforce_deadlines(self):
+        # runs only while there are deadlines to watch
+        while self.deadlines:
+            greenhouse.pause_for(self.deadline_check_interval)
+            now = util.monotonic()
+            for connection, glet in self.deadlines.items():
+                if connection.deadline is None or connection.deadline > now:
+                    continue
+                del self.deadlines[connection]
+                if not glet.dead:
+                    connection.timed_out = True
+                    connection.closing = True
+                    greenhouse.schedule_exception(
+                            connections.RequestTimeout(), glet)
+        self.deadline_enforcer = None
 
     def pre_fork_setup(self):
         super(TCPServer, self).pre_fork_setup()
         self.socket.listen(self.listen_backlog)
 
+    def worker_setup(self):
+        super(TCPServer, self).worker_setup()
+        if self.reuse_port:
+            self.socket.listen(self.listen_backlog)
+
     def serve(self):
         """run the server at the provided address forever.
 
@@ -125,10 +298,18 @@ class TCPServer(BaseServer):
             while not self.shutting_down:
                 try:
                     client_sock, client_address = self.socket.accept()
+                    if not self.admit_connection():
+                        self.shed(client_sock, "connections")
+                        del client_sock
+                        continue
                     handler = self.connection_handler(
                             client_sock,
                             client_address,
                             self)
+                    # counted here rather than once the connection's
+                    # coroutine runs, or a burst of accepts would all be
+                    # admitted against the same count
+                    self.open_connections += 1
                 except socket.error, error:
                     if error.args[0] in (errno.ENFILE, errno.EMFILE):
                         # max open connections
@@ -177,8 +358,75 @@ class TCPServer(BaseServer):
 
 
 class UDPServer(BaseServer):
+    """the master UDP server
+
+    to use, subclass it and override handle_packet(), or handle_packets() to
+    work with several datagrams at a time, then create an instance with a
+    (host, port) address pair and call its serve() method.
+
+    * max_packet_size is the largest datagram that will be read in full.
+
+    * batch_size is the most datagrams serve() will read each time the socket
+      becomes readable. with more than 1, datagrams are read into buffers that
+      are allocated once and re-used, and handle_packets() gets each batch as
+      a list of (data, address) pairs where data is a memoryview into one of
+      those buffers (so it is only valid until handle_packets() returns).
+      replies sent with sendto() from within handle_packets() are queued and
+      sent together once it returns.
+
+    * handler_pool_size, if set, is a number of coroutines that run
+      handle_packet() so that a handler blocking on cooperative I/O doesn't
+      stop the socket from being read. serve() then only reads datagrams and
+      queues them for the pool (handle_packets() is not used).
+
+    * handler_queue_depth is how many datagrams may wait for the handler pool.
+
+    * overflow_policy is what happens to a datagram that arrives when that
+      queue is full: "drop-newest" drops it, "drop-oldest" drops the longest
+      queued one to make room, and "block" stops reading the socket until
+      there is room (leaving the kernel to drop datagrams).
+
+    the received and dropped attributes count datagrams read from the socket
+    and datagrams dropped because the handler pool's queue was full.
+
+    shutdown() stops serve() reading, lets the handler pool finish whatever is
+    already queued, and then closes the socket and sets the `done` event.
+
+    to run under a Monitor, set reuse_port so that each worker gets its own
+    SO_REUSEPORT socket. the kernel then spreads datagrams across them by a
+    hash of the source address, rather than every worker racing to read the
+    same socket.
+    """
     socket_type = socket.SOCK_DGRAM
     max_packet_size = 8192
+    batch_size = 1
+
+    handler_pool_size = 0
+    handler_queue_depth = 1024
+    overflow_policy = "drop-newest"
+
+    _stop = object()
+
+    class _Shutdown(Exception):
+        pass
+
+    def __init__(self, *args, **kwargs):
+        super(UDPServer, self).__init__(*args, **kwargs)
+        self.done = greenhouse.Event()
+        self._outbox = None
+        self._handler_queue = None
+        self._handlers = greenhouse.Counter()
+        self._reader = None
+        self.received = self.dropped = 0
+
+    def _recv(self, method, *args):
+        # the reading coroutine only blocks in here, so this is
+        # the only place shutdown() needs to be able to interrupt
+        self._reader = greenhouse.getcurrent()
+        try:
+            return getattr(self.socket, method)(*args)
+        finally:
+            self._reader = None
 
     def serve(self):
         if self.daemonize and os.environ.get('DAEMON', None) != 'yes':
@@ -188,16 +436,125 @@ class UDPServer(BaseServer):
         if not self.is_setup:
             self.setup()
 
+        if self.handler_pool_size:
+            self._start_handler_pool()
+
         self.ready.set()
         try:
-            while not self.shutting_down:
-                self.handle_packet(*self.socket.recvfrom(self.max_packet_size))
-                if not self.shutting_down:
-                    greenhouse.pause()
-        except KeyboardInterrupt:
+            if self.batch_size > 1:
+                self._serve_batches()
+            else:
+                while not self.shutting_down:
+                    data, address = self._recv(
+                            "recvfrom", self.max_packet_size)
+                    self.received += 1
+                    if self._handler_queue is None:
+                        self.handle_packet(data, address)
+                    else:
+                        self._enqueue(data, address)
+                    if not self.shutting_down:
+                        greenhouse.pause()
+        except (KeyboardInterrupt, self._Shutdown):
             pass
         finally:
+            if self._handler_queue is not None:
+                self._stop_handler_pool()
+                self._handlers.wait()
             self.cleanup()
+            self.done.set()
+
+    def shutdown(self):
+        self.shutting_down = True
+        if self._reader is not None:
+            greenhouse.schedule_exception(self._Shutdown(), self._reader)
+
+    def _start_handler_pool(self):
+        if self.overflow_policy == "block":
+            self._handler_queue = greenhouse.Queue(self.handler_queue_depth)
+        else:
+            self._handler_queue = greenhouse.Queue()
+        for i in xrange(self.handler_pool_size):
+            greenhouse.schedule(self._run_handler)
+
+    def _stop_handler_pool(self):
+        for i in xrange(self.handler_pool_size):
+            self._handler_queue.put(self._stop)
+
+    def _run_handler(self):
+        queue = self._handler_queue
+        with self._handlers:
+            while 1:
+                item = queue.get()
+                if item is self._stop:
+                    break
+                try:
+                    self.handle_packet(*item)
+                except Exception:
+                    greenhouse.handle_exception(*sys.exc_info())
+                del item
+
+    def _enqueue(self, data, address):
+        queue = self._handler_queue
+        while (self.overflow_policy != "block"
+                and queue.qsize() >= self.handler_queue_depth):
+            if self.overflow_policy == "drop-oldest":
+                queue.get_nowait()
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return
+        queue.put((data, address))
+
+    def _serve_batches(self):
+        size = self.max_packet_size
+        buffers = [bytearray(size) for i in xrange(self.batch_size)]
+        views = [memoryview(buf) for buf in buffers]
+
+        while not self.shutting_down:
+            # block (cooperatively) for the first datagram...
+            nbytes, address = self._recv("recvfrom_into", buffers[0], size)
+            if not nbytes and address[0] is None:
+                # the socket has been closed
+                break
+            batch = [(views[0][:nbytes], address)]
+            pooled = self._handler_queue is not None
+
+            # ...then take whatever else has already arrived
+            self.socket.setblocking(False)
+            try:
+                for i in xrange(1, self.batch_size):
+                    try:
+                        nbytes, address = self.socket.recvfrom_into(
+                                buffers[i], size)
+                    except socket.error, exc:
+                        if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            break
+                        raise
+                    batch.append((views[i][:nbytes], address))
+            finally:
+                self.socket.setblocking(True)
+            self.received += len(batch)
+
+            if pooled:
+                # the buffers get re-used, so the pool needs copies
+                for data, address in batch:
+                    self._enqueue(data.tobytes(), address)
+                del batch
+                if not self.shutting_down:
+                    greenhouse.pause()
+                continue
+
+            self._outbox = []
+            try:
+                self.handle_packets(batch)
+            finally:
+                outbox, self._outbox = self._outbox, None
+                del batch
+            for data, address in outbox:
+                self.socket.sendto(data, address)
+
+            if not self.shutting_down:
+                greenhouse.pause()
 
     def cleanup(self):
         self.socket.close()
@@ -205,5 +562,17 @@ class UDPServer(BaseServer):
     def handle_packet(self, data, address):
         raise NotImplementedError()
 
+    def handle_packets(self, batch):
+        """handle a list of (data, address) datagrams read in one go
+
+        only used with a batch_size over 1 and no handler pool. the default
+        implementation passes each datagram to handle_packet() as a string.
+        """
+        for data, address in batch:
+            self.handle_packet(data.tobytes(), address)
+
     def sendto(self, data, address):
+        if self._outbox is not None:
+            self._outbox.append((data, address))
+            return len(data)
         return self.socket.sendto(data, address)
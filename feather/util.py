@@ -1,13 +1,20 @@
+from __future__ import with_statement
+
+import ctypes
 import errno
+import glob
 import os
 import resource
 import stat
 import sys
+import time
 
 from greenhouse import scheduler
 
 
-__all__ = ["background"]
+__all__ = ["background", "monotonic", "rss", "memory_usage",
+        "set_child_subreaper", "parse_cpulist", "online_cpus", "cpu_nodes",
+        "set_cpu_affinity"]
 
 
 try:
@@ -35,3 +42,146 @@ def background():
         sys.exit(0)
 
     scheduler.reset_poller()
+
+
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _find_clock_gettime():
+    # older glibcs only have it in librt
+    for name in (None, "librt.so.1"):
+        try:
+            return ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            pass
+    return None
+
+_clock_gettime = _find_clock_gettime()
+
+def monotonic():
+    """seconds since some arbitrary point, from a clock that only goes forward
+
+    unlike time.time() it isn't thrown off by the system clock being set, so
+    it's the one to measure durations with. falls back to time.time() where
+    there's no clock_gettime.
+    """
+    if _clock_gettime is None:
+        return time.time()
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ts.tv_sec + ts.tv_nsec / 1e9
+
+
+def rss(pid):
+    "resident set size of a process in bytes, or None if it can't be read"
+    try:
+        with open('/proc/%d/statm' % pid) as fp:
+            pages = int(fp.read().split()[1])
+    except (EnvironmentError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def memory_usage(pid):
+    """a process' memory use in bytes, from /proc/<pid>/smaps
+
+    returns a dict with "rss", "pss", "shared" and "private" keys, or None if
+    smaps can't be read. "shared" is resident memory also mapped by other
+    processes (like the pages a worker still shares with its master), and
+    "private" is what only this process has.
+    """
+    usage = dict.fromkeys(("rss", "pss", "shared", "private"), 0)
+    fields = {
+        "Rss:": "rss",
+        "Pss:": "pss",
+        "Shared_Clean:": "shared",
+        "Shared_Dirty:": "shared",
+        "Private_Clean:": "private",
+        "Private_Dirty:": "private",
+    }
+    try:
+        with open('/proc/%d/smaps' % pid) as fp:
+            for line in fp:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    usage[fields[parts[0]]] += int(parts[1]) * 1024
+    except (EnvironmentError, IndexError, ValueError):
+        return None
+    return usage
+
+
+PR_SET_CHILD_SUBREAPER = 36
+
+def set_child_subreaper():
+    """have orphaned descendants reparented to this process instead of init
+
+    so that the process gets SIGCHLD for, and can wait() on, grandchildren
+    whose parents have exited. returns whether it worked (it needs linux 3.4)
+    """
+    try:
+        prctl = ctypes.CDLL(None, use_errno=True).prctl
+    except (OSError, AttributeError):
+        return False
+    return prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+
+
+def parse_cpulist(cpulist):
+    "parse a kernel-style CPU list like '0-3,8,10-11' into a list of ints"
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(xrange(int(first), int(last or first) + 1))
+    return cpus
+
+
+def online_cpus():
+    try:
+        with open('/sys/devices/system/cpu/online') as fp:
+            return parse_cpulist(fp.read())
+    except EnvironmentError:
+        return range(os.sysconf('SC_NPROCESSORS_ONLN'))
+
+
+def cpu_nodes():
+    """the online CPUs grouped by NUMA node, as a list of lists
+
+    without NUMA information there is just one group with every CPU.
+    """
+    online = set(online_cpus())
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    paths.sort(key=lambda path: int(path.split('/')[-2][4:]))
+    for path in paths:
+        try:
+            with open(path) as fp:
+                cpus = [cpu for cpu in parse_cpulist(fp.read())
+                        if cpu in online]
+        except EnvironmentError:
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(online)]
+
+
+CPU_SETSIZE = 1024
+
+def set_cpu_affinity(cpus, pid=0):
+    "restrict a process (default the current one) to run on only `cpus`"
+    if hasattr(os, 'sched_setaffinity'):
+        return os.sched_setaffinity(pid, cpus)
+
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // bits))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
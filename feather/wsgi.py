@@ -1,14 +1,17 @@
 import logging
+import sys
+import tempfile
 import urllib
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
-from feather import http
+from feather import http, pools
 
 
-__all__ = ["WSGIHTTPRequestHandler", "serve"]
+__all__ = ["WSGIHTTPRequestHandler", "Router", "parse_mount", "server",
+        "serve"]
 
 
 # the hoops one has to jump through to let the 'wsgiapp'
@@ -19,6 +22,13 @@ class _wsgiapp_callable(type):
         return super(_wsgiapp_callable, metacls).__new__(
                 metacls, name, bases, attrs)
 
+    def __setattr__(cls, name, value):
+        # so the app can also be swapped in after the class is created
+        if name == 'wsgiapp':
+            super(_wsgiapp_callable, cls).__setattr__(
+                    '_wsgiapp_container', (value,))
+        super(_wsgiapp_callable, cls).__setattr__(name, value)
+
 
 class _WSGIErrors(object):
     def __init__(self, logger, urgency):
@@ -48,23 +58,106 @@ def _chain(*iterators):
             pass
 
 
+def _run_buffered(app, environ, start_response):
+    # call a WSGI app and exhaust its response in one go, so that all of the
+    # app's code can run in a ThreadPool thread
+    body = app(environ, start_response)
+    try:
+        return list(body)
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
 class WSGIHTTPRequestHandler(http.HTTPRequestHandler):
     """a fully implemented HTTPRequestHandler, ready to run a WSGI app.
 
     subclass and override the wsgiapp attribute to your wsgi application and
     you are off to the races.
+
+    set thread_pool to a feather.pools.ThreadPool to run the app (and the
+    iteration of its response, which is then buffered) in a pool thread rather
+    than in the connection's coroutine. this is for apps that make blocking
+    calls greenhouse can't make cooperative. the request body is read before
+    the app is called, so wsgi.input can be read from the thread. it is kept
+    in memory up to buffered_body_size bytes, and spooled to a temporary file
+    past that. requests that arrive while the pool's queue is full get a 503
+    before any of their body is read.
+
+    set response_cache to a feather.cache.ResponseCache to serve repeated GETs
+    from the cache without running the app at all.
+
+    set coalescer to a feather.cache.Coalescer so that identical GETs arriving
+    while one is already running the app wait for and share its response.
     """
     __metaclass__ = _wsgiapp_callable
 
     wsgiapp = None
+    thread_pool = None
+    buffered_body_size = 1024 * 1024
+    response_cache = None
+    coalescer = None
+    _cache_key = None
+
+    def handle(self, request):
+        if self.response_cache is not None:
+            key = self.response_cache.key(request)
+            if key is not None:
+                entry = self.response_cache.get(key)
+                if entry is not None:
+                    return self._format_cached(entry)
+                self._cache_key = key
+
+        return super(WSGIHTTPRequestHandler, self).handle(request)
+
+    def _format_cached(self, entry):
+        head = entry.head
+        if self.connection.closing or not self.connection.keepalive_timeout:
+            head += 'Connection: close\r\n'
+        head += '\r\n'
+        return ((head + entry.body,), (entry.code, len(head)))
 
     def do_everything(self, request):
+        if self.coalescer is not None:
+            key = self.coalescer.key(request)
+            if key is not None:
+                return self._coalesce(key, request)
+        self._run_app(request)
+
+    def _coalesce(self, key, request):
+        flight = self.coalescer.join(key)
+
+        if flight is None:
+            # nobody else is running this request, so it's up to us
+            try:
+                self._run_app(request)
+                if not isinstance(self._body, str):
+                    self._body = ''.join(self._body)
+            except:
+                self.coalescer.fail(key, sys.exc_info())
+                raise
+            self.coalescer.finish(
+                    key, self._code or 200, self._headers, self._body)
+            return
+
+        result = self.coalescer.wait(flight)
+        if result is None:
+            # the response was one that mustn't be shared
+            self._run_app(request)
+            return
+
+        code, headers, body = result
+        self.set_code(code)
+        self.add_headers(headers)
+        self.set_body(body)
+
+    def _run_app(self, request):
         environ = {
             'wsgi.version': (1, 0),
             'wsgi.url_scheme': request.scheme or 'http',
             'wsgi.input': request.content,
             'wsgi.errors': _WSGIErrors(self.server.error_log, logging.ERROR),
-            'wsgi.multithread': False,
+            'wsgi.multithread': self.thread_pool is not None,
             'wsgi.multiprocess': self.server.worker_count > 1,
             'wsgi.run_once': False,
             'SCRIPT_NAME': '',
@@ -87,6 +180,11 @@ class WSGIHTTPRequestHandler(http.HTTPRequestHandler):
         for name, value in request.headers.items():
             environ['HTTP_%s' % name.replace('-', '_').upper()] = value
 
+        if self.process_pool is not None:
+            environ['feather.offload'] = self.offload
+
+        environ['feather.timings'] = request.timings
+
         # the WSGI specification's handling of request headers sucks, so we're
         # going to extend the spec here and provide a useful representation
         environ['feather.headers'] = [tuple(h.rstrip("\r\n").split(":", 1))
@@ -112,7 +210,30 @@ class WSGIHTTPRequestHandler(http.HTTPRequestHandler):
 
             return write
 
-        body = self._wsgiapp_container[0](environ, start_response)
+        app = self._wsgiapp_container[0]
+        if self.thread_pool is None:
+            body = app(environ, start_response)
+        else:
+            if self.thread_pool.full:
+                # don't bother taking in a body we won't get to use
+                raise http.HTTPError(503)
+
+            # request.content reads through greenhouse, which can't be
+            # done from a pool thread, so read the body here first
+            body = tempfile.SpooledTemporaryFile(self.buffered_body_size)
+            while 1:
+                chunk = request.content.read(65536)
+                if not chunk:
+                    break
+                body.write(chunk)
+            body.seek(0)
+            environ['wsgi.input'] = body
+            try:
+                body = self.thread_pool.run(
+                        _run_buffered, app, environ, start_response)
+            except pools.PoolFull:
+                raise http.HTTPError(503)
+
         prefix = collector[0].getvalue()
 
         if prefix:
@@ -123,6 +244,11 @@ class WSGIHTTPRequestHandler(http.HTTPRequestHandler):
                 first_chunk = ''
             body = _chain((prefix + first_chunk,), body_iterable)
 
+        if self._cache_key is not None:
+            body = self.response_cache.collect(self._cache_key,
+                    self._code or 200, self._headers, body,
+                    self.connection.http_version)
+
         self.set_body(body)
 
     do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = do_everything
@@ -133,18 +259,143 @@ class WSGIHTTPRequestHandler(http.HTTPRequestHandler):
         raise AttributeError(name)
 
 
+class Router(object):
+    """a WSGI app that dispatches to other WSGI apps by host and path prefix
+
+    mount() apps under path prefixes, optionally for a particular host. the
+    host may be exact ("api.example.com") or a wildcard for subdomains
+    ("*.example.com"). requests for a host with no matching mount fall back to
+    the mounts made without a host, and requests matching nothing get a 404.
+
+    mounts are compiled on first use into a dict of hosts, each holding a trie
+    of path segments, so routing costs a dict lookup per path segment however
+    many apps are mounted. the longest matching prefix wins, and it is moved
+    from the end of PATH_INFO to the end of SCRIPT_NAME for the mounted app.
+    """
+    def __init__(self, mounts=()):
+        self._mounts = []
+        self._index = None
+        for mount in mounts:
+            self.mount(*mount)
+
+    def mount(self, prefix, app, host=None):
+        "route requests under path `prefix` (for `host`, if given) to `app`"
+        segments = [seg for seg in prefix.split('/') if seg]
+        self._mounts.append((host and host.lower(), segments, app))
+        self._index = None
+
+    def compile(self):
+        index = {}
+        for host, segments, app in self._mounts:
+            node = index.setdefault(host, [None, {}])
+            for segment in segments:
+                node = node[1].setdefault(segment, [None, {}])
+            node[0] = app
+        self._index = index
+
+    def _match(self, host, segments):
+        node = self._index.get(host)
+        if node is None:
+            return None, 0
+        app, depth = node[0], 0
+        for i, segment in enumerate(segments):
+            node = node[1].get(segment)
+            if node is None:
+                break
+            if node[0] is not None:
+                app, depth = node[0], i + 1
+        return app, depth
+
+    def route(self, host, path):
+        """find the app for a request
+
+        returns a three-tuple of the app (or None), the matched portion of the
+        path and the remainder
+        """
+        if self._index is None:
+            self.compile()
+
+        segments = path.split('/')[1:]
+        host = host.split(':', 1)[0].lower()
+
+        app, depth = self._match(host, segments)
+        labels = host.split('.')
+        for i in xrange(1, len(labels)):
+            if app is not None:
+                break
+            app, depth = self._match('*.' + '.'.join(labels[i:]), segments)
+        if app is None:
+            app, depth = self._match(None, segments)
+        if app is None:
+            return None, '', path
+
+        matched = segments[:depth]
+        rest = segments[depth:]
+        return (app, matched and '/' + '/'.join(matched) or '',
+                rest and '/' + '/'.join(rest) or '')
+
+    def __call__(self, environ, start_response):
+        app, matched, rest = self.route(
+                environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+                environ.get('PATH_INFO', ''))
+
+        if app is None:
+            start_response("404 Not Found", [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', '9')])
+            return ["Not Found"]
+
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + matched
+        environ['PATH_INFO'] = rest
+        return app(environ, start_response)
+
+
+def parse_mount(mount):
+    """parse a "[HOST]/PREFIX=APP" mount into a (prefix, app, host) triple
+
+    the host is optional, and is exact ("api.example.com/v1=...") or a
+    wildcard ("*.example.com/=..."). it must contain a dot, so that a prefix
+    which is just missing its leading slash is an error rather than quietly
+    becoming a host. raises ValueError for anything malformed.
+    """
+    prefix, sep, app = mount.partition('=')
+    if not (sep and app):
+        raise ValueError("mount %r has no app after '='" % mount)
+
+    host = None
+    if not prefix.startswith('/'):
+        host, _, prefix = prefix.partition('/')
+        prefix = '/' + prefix
+        wildcard = host.startswith('*.')
+        if '.' not in host or '*' in (host[2:] if wildcard else host):
+            raise ValueError(("mount %r must start with '/', or with a host " +
+                    "like 'api.example.com' or '*.example.com'") % mount)
+
+    return prefix, app, host
+
+
 def server(address,
         wsgiapp,
         https=False,
         keepalive_timeout=30,
         traceback_body=False,
         worker_count=None,
+        thread_pool=None,
+        process_pool=None,
+        response_cache=None,
+        coalescer=None,
         **https_kwargs):
     app, keepalive, tbbody = wsgiapp, keepalive_timeout, traceback_body
+    threads, processes, cache = thread_pool, process_pool, response_cache
+    coalesce = coalescer
 
     class RequestHandler(WSGIHTTPRequestHandler):
         wsgiapp = app
         traceback_body = tbbody
+        thread_pool = threads
+        process_pool = processes
+        response_cache = cache
+        coalescer = coalesce
 
     class Connection(http.HTTPConnection):
         request_handler = RequestHandler
@@ -165,6 +416,10 @@ def serve(address,
         keepalive_timeout=30,
         traceback_body=False,
         worker_count=None,
+        thread_pool=None,
+        process_pool=None,
+        response_cache=None,
+        coalescer=None,
         **https_kwargs):
     "shortcut function to serve a wsgi app on an address"
     server(
@@ -174,5 +429,9 @@ def serve(address,
             keepalive_timeout=keepalive_timeout,
             traceback_body=traceback_body,
             worker_count=worker_count,
+            thread_pool=thread_pool,
+            process_pool=process_pool,
+            response_cache=response_cache,
+            coalescer=coalescer,
             **https_kwargs
     ).serve()
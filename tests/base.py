@@ -30,10 +30,14 @@ class FeatherTest(unittest.TestCase):
         GTL.release()
 
     @contextlib.contextmanager
-    def wsgi_server(self, app, bind_addr="127.0.0.1", port=9999):
+    def wsgi_server(self, app, bind_addr="127.0.0.1", port=9999,
+            **handler_attrs):
         class RequestHandler(wsgi.WSGIHTTPRequestHandler):
             wsgiapp = app
 
+        for name, value in handler_attrs.items():
+            setattr(RequestHandler, name, value)
+
         class Connection(http.HTTPConnection):
             request_handler = RequestHandler
 
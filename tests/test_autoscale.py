@@ -0,0 +1,105 @@
+import unittest
+
+from feather import autoscale
+
+
+class FakeSlot(object):
+    def __init__(self, pid, busy_time=0.0, connections=0):
+        self.fields = {'pid': pid, 'busy_time': busy_time,
+                'connections': connections}
+
+    def get(self, name):
+        return self.fields[name]
+
+
+def busy(*busy_times):
+    return [FakeSlot(pid, busy_time) for pid, busy_time in
+            enumerate(busy_times)]
+
+
+def connections(*counts):
+    return [FakeSlot(pid, connections=count) for pid, count in
+            enumerate(counts)]
+
+
+class AutoscalerTests(unittest.TestCase):
+    def test_validation(self):
+        self.assertRaises(ValueError, autoscale.Autoscaler, 0, 4)
+        self.assertRaises(ValueError, autoscale.Autoscaler, 4, 2)
+        self.assertRaises(ValueError, autoscale.Autoscaler, 1, 4,
+                metric="rss")
+
+    def test_measure_busy(self):
+        scaler = autoscale.Autoscaler(1, 8)
+
+        # it takes two samples to get a rate
+        self.assertEqual(scaler.measure(busy(0.0, 0.0), 100), None)
+        self.assertEqual(scaler.measure(busy(3.0, 1.0), 110), 0.4)
+
+        # a new worker's busy time counts from zero
+        self.assertEqual(scaler.measure(busy(4.0, 2.0, 3.0), 120), 0.5)
+
+        # no time passed
+        self.assertEqual(scaler.measure(busy(5.0, 3.0, 4.0), 120), None)
+
+    def test_measure_connections(self):
+        scaler = autoscale.Autoscaler(1, 8, metric="connections")
+        self.assertEqual(scaler.measure(connections(3, 0, 5), 100), 8)
+
+    def test_decide(self):
+        # (current workers, connections per worker, expected decision)
+        for current, counts, expected in [
+                # load / target, rounded up
+                (2, (2, 2), 4),
+                (2, (1, 1), 2),
+                (2, (2, 3), 5),
+                # bounded by max_workers and min_workers
+                (2, (20, 20), 6),
+                (3, (0, 0, 0), 2),
+                (8, (20, 20), 6),
+                (1, (), 2),
+                # decreases are one worker at a time
+                (5, (1, 1, 0, 0, 0), 4)]:
+            scaler = autoscale.Autoscaler(2, 6, target=1.0,
+                    metric="connections")
+            self.assertEqual(
+                    scaler.decide(current, connections(*counts), now=1000),
+                    expected, (current, counts))
+            self.assertEqual(scaler.load, sum(counts))
+
+    def test_unknown_load(self):
+        scaler = autoscale.Autoscaler(2, 6)
+        self.assertEqual(scaler.decide(1, busy(0.0), now=1000), 2)
+        self.assertEqual(scaler.decide(4, busy(0.0), now=1000), 4)
+        self.assertEqual(scaler.decide(9, busy(0.0), now=1000), 6)
+
+    def test_cooldowns(self):
+        scaler = autoscale.Autoscaler(1, 10, target=1.0, metric="connections",
+                scale_up_cooldown=30, scale_down_cooldown=300)
+
+        self.assertEqual(scaler.decide(2, connections(2, 2), now=1000), 4)
+
+        # held back from growing again until scale_up_cooldown has passed
+        self.assertEqual(scaler.decide(4, connections(2, 2, 2), now=1029), 4)
+        self.assertEqual(scaler.decide(4, connections(2, 2, 2), now=1030), 6)
+
+        # and from shrinking until scale_down_cooldown has
+        self.assertEqual(scaler.decide(6, connections(0), now=1329), 6)
+        self.assertEqual(scaler.decide(6, connections(0), now=1330), 5)
+        self.assertEqual(scaler.decide(5, connections(0), now=1400), 5)
+        self.assertEqual(scaler.decide(5, connections(0), now=1630), 4)
+
+        # a hold doesn't count as a change
+        self.assertEqual(scaler.decide(4, connections(9), now=1659), 4)
+        self.assertEqual(scaler.decide(4, connections(9), now=1660), 9)
+
+    def test_busy_scaling(self):
+        scaler = autoscale.Autoscaler(1, 10, target=0.5)
+        self.assertEqual(scaler.decide(2, busy(0.0, 0.0), now=1000), 2)
+
+        # 1.5 request-seconds per second, at 0.5 per worker
+        self.assertEqual(scaler.decide(2, busy(5.0, 10.0), now=1010), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+
+from feather import cache, http
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def request(method='GET', path='/', headers=None):
+    return http.HTTPRequest(method=method, host='localhost', path=path,
+            querystring='', headers=headers or {})
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self._time, cache.time = cache.time, self.clock
+
+    def tearDown(self):
+        cache.time = self._time
+
+    def test_keys(self):
+        rc = cache.ResponseCache(vary=['Accept-Encoding'])
+        self.assertEqual(rc.key(request(headers={'accept-encoding': 'gzip'})),
+                rc.key(request(headers={'accept-encoding': 'gzip'})))
+        self.assertNotEqual(rc.key(request()),
+                rc.key(request(headers={'accept-encoding': 'gzip'})))
+        self.assertEqual(rc.key(request(method='POST')), None)
+
+    def test_authorization_not_cached(self):
+        rc = cache.ResponseCache()
+        self.assertEqual(
+                rc.key(request(headers={'authorization': 'Basic Zm9vOmJhcg=='})),
+                None)
+
+    def test_ttl(self):
+        rc = cache.ResponseCache(default_ttl=5)
+        self.assertEqual(rc.ttl(200, []), 5)
+        self.assertEqual(rc.ttl(200, [('Cache-Control', 'max-age=60')]), 60)
+        self.assertEqual(rc.ttl(200,
+            [('Cache-Control', 'max-age=60, s-maxage=120')]), 120)
+        self.assertEqual(rc.ttl(500, [('Cache-Control', 'max-age=60')]), 0)
+        self.assertEqual(rc.ttl(200,
+            [('Cache-Control', 'max-age=60, private')]), 0)
+        self.assertEqual(rc.ttl(200,
+            [('Cache-Control', 'private="Set-Cookie", max-age=60')]), 0)
+        self.assertEqual(rc.ttl(200,
+            [('Cache-Control', 'max-age=60, no-cache="x"')]), 0)
+        self.assertEqual(rc.ttl(200,
+            [('Cache-Control', 'max-age=60'), ('Set-Cookie', 'a=b')]), 0)
+        self.assertEqual(rc.ttl(200,
+            [('Cache-Control', 'max-age=60'), ('Vary', 'Cookie')]), 0)
+
+    def test_expiry(self):
+        rc = cache.ResponseCache()
+        key = rc.key(request())
+        rc.store(key, 200, [('Cache-Control', 'max-age=10')], "body")
+
+        self.clock.now += 9
+        entry = rc.get(key)
+        self.assertEqual(entry.body, "body")
+        assert entry.head.startswith("HTTP/1.1 200 OK\r\n")
+        assert "Content-Length: 4\r\n" in entry.head
+
+        self.clock.now += 1
+        self.assertEqual(rc.get(key), None)
+        self.assertEqual(rc.size, 0)
+        self.assertEqual((rc.hits, rc.misses), (1, 1))
+
+    def test_no_ttl_not_stored(self):
+        rc = cache.ResponseCache()
+        key = rc.key(request())
+        rc.store(key, 200, [], "body")
+        self.assertEqual(rc.get(key), None)
+
+    def test_lru_eviction(self):
+        rc = cache.ResponseCache(default_ttl=60)
+        keys = [rc.key(request(path='/%d' % i)) for i in xrange(3)]
+
+        rc.store(keys[0], 200, [], "x" * 100)
+        rc.max_bytes = rc.size * 2
+        rc.store(keys[1], 200, [], "x" * 100)
+
+        # touching the first makes the second the least recently used
+        assert rc.get(keys[0]) is not None
+        rc.store(keys[2], 200, [], "x" * 100)
+
+        assert rc.get(keys[0]) is not None
+        self.assertEqual(rc.get(keys[1]), None)
+        assert rc.get(keys[2]) is not None
+        assert rc.size <= rc.max_bytes
+
+    def test_too_big_not_stored(self):
+        rc = cache.ResponseCache(max_bytes=50, default_ttl=60)
+        key = rc.key(request())
+        rc.store(key, 200, [], "x" * 100)
+        self.assertEqual(rc.get(key), None)
+        self.assertEqual(rc.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
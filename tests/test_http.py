@@ -1,10 +1,12 @@
 from __future__ import with_statement
 
+import logging
 import os
+import socket
 import unittest
 import urllib2
 
-from feather import http
+from feather import http, pools
 import greenhouse
 from base import FeatherTest
 
@@ -71,6 +73,137 @@ class HTTPServerTests(FeatherTest):
             response = sock.recv(8192)
             self.assertEqual(response, "")
 
+    def test_request_timeout(self):
+        class Handler(http.HTTPRequestHandler):
+            def do_GET(self, request):
+                greenhouse.pause_for(1.0)
+                self.set_body('too late')
+
+        with self.http_server(Handler, port=9191) as server:
+            server.request_timeout = 0.1
+            sock = greenhouse.Socket()
+            sock.connect(("", 9191))
+
+            sock.send("GET / HTTP/1.1\r\nHost: localhost:9191\r\n\r\n")
+            response = sock.recv(8192)
+            self.assertEqual(response.split("\r\n")[0],
+                    "HTTP/1.1 504 Gateway Timeout")
+            assert "Connection: close" in response
+            self.assertEqual(sock.recv(8192), "")
+
+    def test_shed_requests(self):
+        with self.http_server(self.HelloWorldHandler, port=9292) as server:
+            server.max_in_flight = 0
+            sock = greenhouse.Socket()
+            sock.connect(("", 9292))
+
+            sock.send("GET / HTTP/1.1\r\nHost: localhost:9292\r\n\r\n")
+            response = sock.recv(8192)
+            self.assertEqual(response, server.overload_response)
+            assert "Retry-After: 1\r\n" in response
+            self.assertEqual(sock.recv(8192), "")
+
+    def test_shed_queue_delay(self):
+        with self.http_server(self.HelloWorldHandler, port=9294) as server:
+            # every delay is over a target of zero, and an interval of zero
+            # means shedding starts right away
+            server.queue_delay_target = 0
+            server.queue_delay_interval = 0
+            sock = greenhouse.Socket()
+            sock.connect(("", 9294))
+
+            sock.send("GET / HTTP/1.1\r\nHost: localhost:9294\r\n\r\n")
+            response = sock.recv(8192)
+            self.assertEqual(response.split("\r\n")[0],
+                    "HTTP/1.1 503 Service Unavailable")
+            assert "Retry-After: 1\r\n" in response
+            self.assertEqual(sock.recv(8192), "")
+
+    def test_shed_connection_burst(self):
+        with self.http_server(self.HelloWorldHandler, port=9293) as server:
+            server.max_connections = 2
+
+            # connect them all before the server gets to accept any
+            socks = []
+            for i in xrange(5):
+                sock = socket.socket()
+                sock.connect(("127.0.0.1", 9293))
+                sock.sendall("GET / HTTP/1.1\r\nHost: localhost:9293\r\n\r\n")
+                socks.append(sock)
+            greenhouse.pause_for(0.1)
+
+            responses = []
+            for sock in socks:
+                sock.settimeout(1.0)
+                responses.append(sock.recv(8192))
+                sock.close()
+
+        self.assertEqual(
+                [response.split("\r\n")[0] for response in responses],
+                ["HTTP/1.1 200 OK"] * 2 +
+                ["HTTP/1.1 503 Service Unavailable"] * 3)
+
+    def test_slow_request_log(self):
+        records = []
+
+        class Collector(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        def wait_for_backend():
+            greenhouse.pause_for(0.1)
+
+        class Handler(http.HTTPRequestHandler):
+            def do_GET(self, request):
+                if request.path == "/slow":
+                    wait_for_backend()
+                self.set_code(200)
+                self.add_header('Content-Length', '2')
+                self.set_body('ok')
+
+        collector = Collector()
+        logging.getLogger("feather.http.slow").addHandler(collector)
+        try:
+            with self.http_server(Handler, port=9295) as server:
+                server.slow_request_threshold = 0.05
+                server.slow_request_samples = 5
+                sock = greenhouse.Socket()
+                sock.connect(("", 9295))
+                for path in ("/fast", "/slow"):
+                    sock.sendall(
+                            "GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                            % path)
+                    sock.recv(8192)
+
+                # with nothing in flight the sampler stops
+                greenhouse.pause_for(0.05)
+                self.assertEqual(server.slow_sampler, None)
+        finally:
+            logging.getLogger("feather.http.slow").removeHandler(collector)
+
+        self.assertEqual(len(records), 1)
+        lines = records[0].splitlines()
+        assert lines[0].endswith(
+                ' ms "GET /slow HTTP/1.1" from 127.0.0.1, 39 bytes in, ' +
+                '40 bytes out'), lines[0]
+        assert lines[1].startswith("phases (ms): queue "), lines[1]
+        assert lines[2].endswith(" stack samples:"), lines[2]
+        assert "in wait_for_backend" in records[0]
+
+    def test_offload(self):
+        greenhouse.emulation.patch("socket")
+
+        class Handler(http.HTTPRequestHandler):
+            process_pool = pools.ProcessPool(1)
+
+            def do_GET(self, request):
+                self.set_body(str(self.offload(pow, 2, 10)))
+
+        with self.http_server(Handler, port=5656):
+            self.assertEqual(
+                    urllib2.urlopen("http://localhost:5656/").read(),
+                    "1024")
+
 
 class FakeSocket(object):
     def __init__(self, starting_data=None):
@@ -210,6 +343,18 @@ Host: localhost
         self.assertEqual(request.headers.items(), [('host', 'localhost')])
         assert closing
 
+    def test_timings(self):
+        request, closing = self.parse('''GET / HTTP/1.0
+Host: localhost
+
+''')
+
+        timings = request.timings
+        assert timings.accepted <= timings.first_read <= timings.headers_parsed
+        assert timings.read >= 0
+        self.assertEqual(timings.handler_start, None)
+        self.assertEqual(timings.handle, None)
+
     def test_different_headers(self):
         request, closing = self.parse('''GET / HTTP/1.0
 Host: localhost
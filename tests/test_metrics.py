@@ -0,0 +1,156 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from feather import metrics, scoreboard
+import greenhouse
+from base import FeatherTest
+
+
+class RenderTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.board = scoreboard.Scoreboard(
+                os.path.join(self.dir, "scoreboard"), 4)
+
+    def tearDown(self):
+        self.board.close()
+        shutil.rmtree(self.dir)
+
+    def worker(self, requests, connections, times):
+        slot = self.board.allocate()
+        slot.set("requests", requests)
+        slot.set("connections", connections)
+        slot.incr("responses", requests, index=1)
+        for seconds in times:
+            slot.record_time(seconds)
+            slot.incr("handle_sum", seconds)
+        return slot
+
+    def parse(self, page):
+        samples, types = {}, {}
+        for line in page.splitlines():
+            if line.startswith("# TYPE "):
+                name, kind = line.split()[2:]
+                types[name] = kind
+            elif not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = value
+        return samples, types
+
+    def test_render(self):
+        exited = self.worker(5, 1, [0.5])
+        totals = metrics.Totals()
+        totals.add(exited)
+        exited.clear()
+
+        workers = [self.worker(10, 2, [0.001, 0.02]),
+                self.worker(20, 3, [20.0])]
+        page = metrics.render(workers, totals, restarts=1)
+        assert page.endswith("\n")
+        samples, types = self.parse(page)
+
+        self.assertEqual(types["feather_requests_total"], "counter")
+        self.assertEqual(types["feather_connections"], "gauge")
+        self.assertEqual(types["feather_request_duration_seconds"],
+                "histogram")
+        assert "# HELP feather_requests_total requests handled\n" in page
+
+        self.assertEqual(samples["feather_workers"], "2")
+        self.assertEqual(samples["feather_worker_restarts_total"], "1")
+
+        # counters include exited workers, gauges only the running ones
+        self.assertEqual(samples["feather_requests_total"], "35")
+        self.assertEqual(samples['feather_responses_total{code="2xx"}'], "35")
+        self.assertEqual(samples['feather_responses_total{code="5xx"}'], "0")
+        self.assertEqual(samples["feather_connections"], "5")
+
+        # histogram buckets are cumulative
+        name = "feather_request_duration_seconds"
+        for bound, count in [("0.001", "1"), ("0.025", "2"), ("0.5", "3"),
+                ("10.0", "3"), ("+Inf", "4")]:
+            self.assertEqual(samples['%s_bucket{le="%s"}' % (name, bound)],
+                    count, bound)
+        self.assertEqual(samples[name + "_count"], "4")
+        self.assertAlmostEqual(float(samples[name + "_sum"]), 20.521)
+
+    def test_render_empty(self):
+        samples, types = self.parse(metrics.render([]))
+        self.assertEqual(samples["feather_workers"], "0")
+        self.assertEqual(samples["feather_requests_total"], "0")
+        self.assertEqual(
+                samples['feather_scheduler_lag_seconds_bucket{le="+Inf"}'],
+                "0")
+
+
+class MetricsServerTests(FeatherTest):
+    def request(self, path, request):
+        sock = greenhouse.Socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        sock.connect(path)
+        sock.sendall(request)
+        response = ""
+        while 1:
+            data = sock.recv(8192)
+            if not data:
+                break
+            response += data
+        sock.close()
+        return response
+
+    def test_serve(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "metrics.sock")
+        server = metrics.MetricsServer(path, lambda: "feather_workers 1\n")
+        server.start()
+        try:
+            response = self.request(path, "GET /metrics HTTP/1.1\r\n\r\n")
+            head, body = response.split("\r\n\r\n", 1)
+            self.assertEqual(head.split("\r\n")[0], "HTTP/1.0 200 OK")
+            assert "Content-Type: text/plain; version=0.0.4" in head
+            self.assertEqual(body, "feather_workers 1\n")
+
+            response = self.request(path, "GET /other HTTP/1.1\r\n\r\n")
+            assert response.startswith("HTTP/1.0 404 ")
+
+            response = self.request(path, "POST /metrics HTTP/1.1\r\n\r\n")
+            assert response.startswith("HTTP/1.0 405 ")
+        finally:
+            server.close()
+            shutil.rmtree(tmpdir)
+
+    def test_port_not_shared(self):
+        server = metrics.MetricsServer(("127.0.0.1", 9495), lambda: "")
+        server.start()
+        try:
+            other = metrics.MetricsServer(("127.0.0.1", 9495), lambda: "")
+            self.assertRaises(socket.error, other.start)
+        finally:
+            server.close()
+
+    def test_hand_over(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "metrics.sock")
+        old = metrics.MetricsServer(path, lambda: "old\n")
+        old.start()
+        try:
+            old.hand_over()
+            new = metrics.MetricsServer(path, lambda: "new\n")
+            new.start()
+            old.close()
+            assert metrics.MetricsServer.environ_fd_name not in os.environ
+
+            response = self.request(path, "GET /metrics HTTP/1.1\r\n\r\n")
+            self.assertEqual(response.split("\r\n\r\n", 1)[1], "new\n")
+            new.close()
+        finally:
+            os.environ.pop(metrics.MetricsServer.environ_fd_name, None)
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
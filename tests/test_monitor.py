@@ -0,0 +1,271 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from feather import monitor, scoreboard, util
+import greenhouse
+from base import FeatherTest
+
+
+class FakeMonitor(monitor.Monitor):
+    """a Monitor whose workers are only pids in its bookkeeping
+
+    `outcomes` says what each newly forked worker will do: "ready" reports
+    ready, "die" exits before it gets there and "hang" does neither.
+    """
+    def __init__(self, board, count, **kwargs):
+        super(FakeMonitor, self).__init__(None, count, **kwargs)
+        self.master_pid = os.getpid()
+        self.scoreboard = board
+        self.events = []
+        self.outcomes = []
+        self.next_pid = 100
+
+    def fork_worker(self, wid):
+        pid, self.next_pid = self.next_pid, self.next_pid + 1
+        self.events.append(("fork", wid, pid))
+        self._worker_forked(wid, pid, self.scoreboard.allocate())
+
+        outcome = self.outcomes.pop(0) if self.outcomes else "ready"
+        if outcome == "ready":
+            greenhouse.schedule(self.ready_events[pid].set)
+        elif outcome == "die":
+            greenhouse.schedule(self._worker_exited, args=(pid,))
+        return False
+
+
+class RollingReloadTests(FeatherTest):
+    def setUp(self):
+        super(RollingReloadTests, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.board = scoreboard.Scoreboard(
+                os.path.join(self.dir, "scoreboard"), 16)
+
+        # retired workers exit as soon as they get their SIGQUIT
+        self._kill = os.kill
+        def kill(pid, signum):
+            assert signum == signal.SIGQUIT
+            self.monitor.events.append(("kill", pid))
+            greenhouse.schedule(self.monitor._worker_exited, args=(pid,))
+        os.kill = kill
+
+    def tearDown(self):
+        os.kill = self._kill
+        self.board.close()
+        shutil.rmtree(self.dir)
+        super(RollingReloadTests, self).tearDown()
+
+    def start(self, count, **kwargs):
+        self.monitor = FakeMonitor(self.board, count, **kwargs)
+        for wid in xrange(count):
+            self.monitor.fork_worker(wid)
+        greenhouse.pause()
+        del self.monitor.events[:]
+        return self.monitor
+
+    def reload(self):
+        self.monitor.rolling_reload()
+        # let the retired workers exit
+        greenhouse.pause()
+        return self.monitor.events
+
+    def test_surge(self):
+        mon = self.start(2, reload_batch=1, reload_surge=1)
+
+        # each old worker is only retired once its replacement is ready
+        self.assertEqual(self.reload(), [
+            ("fork", 0, 102), ("kill", 100),
+            ("fork", 1, 103), ("kill", 101)])
+        self.assertEqual(mon.workers, {0: 102, 1: 103})
+        self.assertEqual(mon.rev_workers, {102: 0, 103: 1})
+        self.assertEqual(mon.do_not_revive, set())
+        self.assertEqual(mon.replacing, False)
+
+    def test_immediate(self):
+        mon = self.start(4, reload_batch=2, reload_surge=0)
+
+        # without surge a batch's old workers are retired up front
+        self.assertEqual(self.reload(), [
+            ("kill", 100), ("kill", 101), ("fork", 0, 104), ("fork", 1, 105),
+            ("kill", 102), ("kill", 103), ("fork", 2, 106), ("fork", 3, 107)])
+        self.assertEqual(mon.workers, {0: 104, 1: 105, 2: 106, 3: 107})
+
+    def test_partial_surge(self):
+        mon = self.start(2, reload_batch=2, reload_surge=1)
+
+        self.assertEqual(self.reload(), [
+            ("kill", 101), ("fork", 0, 102), ("fork", 1, 103),
+            ("kill", 100)])
+        self.assertEqual(mon.workers, {0: 102, 1: 103})
+
+    def test_replacement_dies(self):
+        mon = self.start(2, reload_batch=1, reload_surge=1)
+        mon.outcomes = ["die"]
+
+        # the old worker takes its wid back and the reload stops there
+        self.assertEqual(self.reload(), [("fork", 0, 102)])
+        self.assertEqual(mon.workers, {0: 100, 1: 101})
+        self.assertEqual(mon.rev_workers, {100: 0, 101: 1})
+        self.assertEqual(mon.replacing, False)
+
+    def test_replacement_dies_without_surge(self):
+        mon = self.start(2, reload_batch=1, reload_surge=0)
+        mon.outcomes = ["die"]
+
+        # with the old worker already gone, the wid is revived as usual
+        self.assertEqual(self.reload(), [
+            ("kill", 100), ("fork", 0, 102), ("fork", 0, 103)])
+        self.assertEqual(mon.workers, {0: 103, 1: 101})
+        self.assertEqual(mon.restarts, {0: 1})
+
+    def test_ready_timeout(self):
+        mon = self.start(2, reload_batch=1, reload_surge=1)
+        mon.RELOAD_READY_TIMEOUT = 0.05
+        mon.outcomes = ["hang"]
+
+        # the old worker is left serving beside the stuck one
+        self.assertEqual(self.reload(), [("fork", 0, 102)])
+        self.assertEqual(mon.workers, {0: 102, 1: 101})
+        self.assertEqual(sorted(mon.rev_workers), [100, 101, 102])
+        self.assertEqual(mon.replacing, False)
+
+
+class CPUPlacementTests(unittest.TestCase):
+    def setUp(self):
+        self.pinned = []
+        self._cpu_nodes = util.cpu_nodes
+        self._set_cpu_affinity = util.set_cpu_affinity
+        util.cpu_nodes = lambda: [[0, 1, 2, 3], [4, 5, 6, 7]]
+        util.set_cpu_affinity = self.pinned.append
+
+    def tearDown(self):
+        util.cpu_nodes = self._cpu_nodes
+        util.set_cpu_affinity = self._set_cpu_affinity
+
+    def plan(self, **kwargs):
+        mon = monitor.Monitor(None, 8, **kwargs)
+        mon.plan_cpus()
+        return mon
+
+    def test_cpu_mode(self):
+        mon = self.plan(cpu_affinity="cpu", reserve_cpus=1)
+
+        # the lowest CPU goes to the master
+        self.assertEqual(self.pinned, [[0]])
+        self.assertEqual(mon.cpu_groups, [[1, 2, 3], [4, 5, 6, 7]])
+
+        # alternating between the nodes, taking each node's CPUs in turn
+        self.assertEqual([mon.worker_cpus(wid) for wid in xrange(8)],
+                [[1], [4], [2], [5], [3], [6], [1], [7]])
+
+    def test_node_mode(self):
+        mon = self.plan(cpu_affinity="node")
+        self.assertEqual(self.pinned, [])
+        self.assertEqual([mon.worker_cpus(wid) for wid in xrange(3)],
+                [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]])
+
+    def test_cpus(self):
+        mon = self.plan(cpu_affinity="cpu", cpus=[1, 2, 3, 6],
+                reserve_cpus=1)
+        self.assertEqual(self.pinned, [[1]])
+        self.assertEqual(mon.cpu_groups, [[2, 3], [6]])
+        self.assertEqual([mon.worker_cpus(wid) for wid in xrange(4)],
+                [[2], [6], [3], [6]])
+
+    def test_all_reserved(self):
+        mon = self.plan(cpu_affinity="cpu", cpus=[0, 1], reserve_cpus=2)
+        self.assertEqual(mon.cpu_groups, [])
+        self.assertEqual(self.pinned, [])
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, monitor.Monitor, None, 1,
+                cpu_affinity="socket")
+
+
+class RecycleTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.board = scoreboard.Scoreboard(
+                os.path.join(self.dir, "scoreboard"), 16)
+        self.rss = {}
+        self._rss = util.rss
+        util.rss = self.rss.get
+
+    def tearDown(self):
+        util.rss = self._rss
+        self.board.close()
+        shutil.rmtree(self.dir)
+
+    def monitor(self, **limits):
+        mon = monitor.Monitor(None, 2, **limits)
+        self.next_pid = 100
+        return mon
+
+    def worker(self, mon, wid, factor=1.0, requests=0, age=0, rss=None,
+            state=scoreboard.STATE_READY):
+        pid, self.next_pid = self.next_pid, self.next_pid + 1
+        slot = self.board.allocate()
+        mon._worker_forked(wid, pid, slot)
+        mon.recycle_factors[pid] = factor
+        slot.set("state", state)
+        slot.set("requests", requests)
+        slot.set("started", time.time() - age)
+        self.rss[pid] = rss
+        return pid
+
+    def test_requests(self):
+        mon = self.monitor(max_requests=1000)
+        self.worker(mon, 0, factor=0.9, requests=899)
+        self.assertEqual(mon.recycle_candidate(), None)
+
+        # the jitter factor scales the limit down
+        pid = self.worker(mon, 1, factor=0.9, requests=900)
+        self.assertEqual(mon.recycle_candidate(),
+                (pid, "handled 900 requests"))
+
+    def test_age(self):
+        mon = self.monitor(max_age=100)
+        self.worker(mon, 0, factor=0.5, age=40)
+        self.assertEqual(mon.recycle_candidate(), None)
+
+        pid = self.worker(mon, 1, factor=0.5, age=60)
+        self.assertEqual(mon.recycle_candidate(), (pid, "60 seconds old"))
+
+    def test_rss(self):
+        mon = self.monitor(max_rss=1000)
+        self.worker(mon, 0, factor=0.8, rss=799)
+        # a worker whose RSS can't be read is left alone
+        self.worker(mon, 1, factor=0.8, rss=None)
+        self.assertEqual(mon.recycle_candidate(), None)
+
+        pid = self.worker(mon, 2, factor=0.8, rss=800)
+        self.assertEqual(mon.recycle_candidate(), (pid, "RSS is 800 bytes"))
+
+    def test_no_limits(self):
+        mon = self.monitor()
+        self.worker(mon, 0, requests=10 ** 9, age=10 ** 6, rss=10 ** 12)
+        self.assertEqual(mon.recycle_candidate(), None)
+
+    def test_skipped(self):
+        mon = self.monitor(max_requests=10)
+
+        # still starting up, or already on its way out
+        self.worker(mon, 0, requests=50, state=scoreboard.STATE_STARTING)
+        self.worker(mon, 1, requests=50, state=scoreboard.STATE_STOPPING)
+        retired = self.worker(mon, 2, requests=50)
+        mon.do_not_revive.add(retired)
+
+        # an old worker that a replacement has taken the wid from
+        self.worker(mon, 3, requests=50)
+        self.worker(mon, 3, requests=0)
+
+        self.assertEqual(mon.recycle_candidate(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from feather import scoreboard
+
+
+class ScoreboardTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "scoreboard")
+        self.board = scoreboard.Scoreboard(self.path, 4)
+
+    def tearDown(self):
+        self.board.close()
+        shutil.rmtree(self.dir)
+
+    def test_fields(self):
+        slot = self.board.slot(2)
+        slot.set("pid", 1234)
+        slot.set("busy_time", 1.5)
+        slot.incr("requests")
+        slot.incr("requests", 41)
+        slot.incr("busy_time", 0.25)
+        slot.incr("responses", 3, index=1)
+
+        self.assertEqual(slot.get("pid"), 1234)
+        self.assertEqual(slot.get("requests"), 42)
+        self.assertEqual(slot.get("busy_time"), 1.75)
+        self.assertEqual(slot.get("responses"), (0, 3, 0, 0, 0))
+
+        # slots don't overlap
+        for index in (1, 3):
+            self.assertEqual(self.board.slot(index).snapshot(),
+                    scoreboard.Slot(self.board.mmap, 0).snapshot())
+
+        slot.clear()
+        self.assertEqual(slot.get("requests"), 0)
+        self.assertEqual(slot.get("responses"), (0,) * 5)
+
+    def test_allocate(self):
+        slots = [self.board.allocate() for i in xrange(4)]
+        self.assertEqual([slot.index for slot in slots], [0, 1, 2, 3])
+        self.assertEqual(self.board.allocate(), None)
+
+        slots[1].set("requests", 10)
+        slots[1].clear()
+        self.assertEqual([slot.index for slot in self.board.active()],
+                [0, 2, 3])
+
+        # a reused slot starts from zero
+        slot = self.board.allocate()
+        self.assertEqual(slot.index, 1)
+        self.assertEqual(slot.get("state"), scoreboard.STATE_STARTING)
+        self.assertEqual(slot.get("requests"), 0)
+
+    def test_open(self):
+        slot = self.board.allocate()
+        slot.set("requests", 7)
+
+        reader = scoreboard.Scoreboard(self.path, readonly=True)
+        try:
+            self.assertEqual(reader.size, 4)
+            self.assertEqual(reader.master_pid, os.getpid())
+            self.assertEqual(reader.slot(0).get("requests"), 7)
+
+            # the mapping is shared, not a copy
+            slot.incr("requests")
+            self.assertEqual(reader.slot(0).get("requests"), 8)
+        finally:
+            reader.close()
+
+    def test_incompatible(self):
+        with open(self.path, "r+b") as fp:
+            fp.write("notfeath")
+        self.assertRaises(ValueError, scoreboard.Scoreboard, self.path)
+
+    def test_histograms(self):
+        slot = self.board.slot(0)
+        for seconds in (0, 0.001, 0.0011, 0.3, 10.0, 11.0):
+            slot.record_time(seconds)
+        slot.record_time(0.02, "lag_times")
+
+        counts = [0] * (len(scoreboard.LATENCY_BUCKETS) + 1)
+        # buckets are inclusive of their upper bounds
+        counts[0] = 2
+        counts[1] = 1
+        counts[scoreboard.LATENCY_BUCKETS.index(0.5)] = 1
+        counts[-2] = 1
+        counts[-1] = 1
+        self.assertEqual(slot.get("handle_times"), tuple(counts))
+
+        lag = slot.get("lag_times")
+        self.assertEqual(sum(lag), 1)
+        self.assertEqual(lag[scoreboard.LATENCY_BUCKETS.index(0.025)], 1)
+
+
+class PercentileTests(unittest.TestCase):
+    def counts(self, by_bound):
+        "histogram counts from {bucket upper bound: count}"
+        bounds = scoreboard.LATENCY_BUCKETS + (float('inf'),)
+        return [by_bound.get(bound, 0) for bound in bounds]
+
+    def test_percentile(self):
+        inf = float('inf')
+        for by_bound, fraction, expected in [
+                ({}, 0.5, None),
+                ({0.01: 10}, 0.5, 0.01),
+                ({0.01: 10}, 0.99, 0.01),
+                ({0.001: 50, 0.1: 50}, 0.5, 0.001),
+                ({0.001: 50, 0.1: 50}, 0.51, 0.1),
+                ({0.001: 98, 1.0: 1, inf: 1}, 0.99, 1.0),
+                ({0.001: 98, 1.0: 1, inf: 1}, 1.0, inf)]:
+            self.assertEqual(
+                    scoreboard.percentile(self.counts(by_bound), fraction),
+                    expected, (by_bound, fraction))
+
+
+if __name__ == '__main__':
+    unittest.main()
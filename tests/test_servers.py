@@ -0,0 +1,141 @@
+from __future__ import with_statement
+
+import contextlib
+import socket
+import unittest
+
+from feather import servers
+import greenhouse
+from base import FeatherTest
+
+
+class UDPServerTests(FeatherTest):
+    @contextlib.contextmanager
+    def udp_server(self, port, **attrs):
+        class Server(servers.UDPServer):
+            pass
+
+        for name, value in attrs.items():
+            setattr(Server, name, value)
+
+        server = Server(("127.0.0.1", port))
+        server.handled = []
+        greenhouse.schedule(server.serve)
+        greenhouse.pause()
+
+        yield server
+
+        server.shutdown()
+        assert not server.done.wait(1.0), "serve() didn't finish"
+
+    def send(self, port, *datagrams):
+        sock = greenhouse.Socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for data in datagrams:
+            sock.sendto(data, ("127.0.0.1", port))
+        return sock
+
+    def test_batches(self):
+        batches = []
+
+        def handle_packets(server, batch):
+            batches.append(len(batch))
+            for data, address in batch:
+                server.sendto(data.tobytes().upper(), address)
+
+        with self.udp_server(9191, batch_size=8,
+                handle_packets=handle_packets) as server:
+            # all sent before the server gets to run, so read in one go
+            sock = self.send(9191, *["a", "b", "c", "d", "e"])
+            replies = [sock.recvfrom(8192)[0] for i in xrange(5)]
+
+        self.assertEqual(batches, [5])
+        self.assertEqual(replies, ["A", "B", "C", "D", "E"])
+        self.assertEqual(server.received, 5)
+
+    def overflow(self, port, policy):
+        release = greenhouse.Event()
+
+        def handle_packet(server, data, address):
+            release.wait()
+            server.handled.append(data)
+
+        with self.udp_server(port, handler_pool_size=1,
+                handler_queue_depth=2, overflow_policy=policy,
+                handle_packet=handle_packet) as server:
+            # the first datagram occupies the only handler...
+            sock = self.send(port, "1")
+            greenhouse.pause_for(0.02)
+
+            # ...so of these, two fit in the queue and two overflow
+            self.send(port, "2", "3", "4", "5")
+            greenhouse.pause_for(0.05)
+
+            release.set()
+            greenhouse.pause_for(0.05)
+
+        return server
+
+    def test_overflow_drop_newest(self):
+        server = self.overflow(9192, "drop-newest")
+        self.assertEqual(server.handled, ["1", "2", "3"])
+        self.assertEqual((server.received, server.dropped), (5, 2))
+
+    def test_overflow_drop_oldest(self):
+        server = self.overflow(9193, "drop-oldest")
+        self.assertEqual(server.handled, ["1", "4", "5"])
+        self.assertEqual((server.received, server.dropped), (5, 2))
+
+    def test_overflow_block(self):
+        server = self.overflow(9194, "block")
+        self.assertEqual(server.handled, ["1", "2", "3", "4", "5"])
+        self.assertEqual((server.received, server.dropped), (5, 0))
+
+    def test_shutdown(self):
+        for port, attrs in [
+                (9195, {}),
+                (9196, {'batch_size': 8}),
+                (9197, {'handler_pool_size': 2})]:
+            class Server(servers.UDPServer):
+                def handle_packet(self, data, address):
+                    pass
+
+            for name, value in attrs.items():
+                setattr(Server, name, value)
+
+            server = Server(("127.0.0.1", port))
+            greenhouse.schedule(server.serve)
+            greenhouse.pause()
+            greenhouse.pause_for(0.01)
+
+            # serve() is blocked reading the socket
+            server.shutdown()
+            assert not server.done.wait(1.0), attrs
+            self.assertRaises(socket.error, server.socket.fileno)
+
+
+class DelayShedderTests(unittest.TestCase):
+    def test_admit(self):
+        shedder = servers.DelayShedder(target=1, interval=10)
+        shedder.below_target = 0
+
+        for now, delay, admitted in [
+                (0, 0.5, True),
+                # over target, but not yet for a whole interval
+                (5, 2, True),
+                (9, 50, True),
+                # over target for an interval: a standing queue
+                (10, 2, False),
+                (12, 1, False),
+                # one delay under target and it all starts over
+                (15, 0.5, True),
+                (16, 0.1, True),
+                (20, 3, True),
+                (25, 3, True),
+                (26, 3, False),
+                (27, 0, True)]:
+            self.assertEqual(shedder.admit(delay, now=now), admitted,
+                    (now, delay))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+
+from feather import util
+
+
+class ParseCPUListTests(unittest.TestCase):
+    def test_parse_cpulist(self):
+        for cpulist, cpus in [
+                ("0-3,8,10-11\n", [0, 1, 2, 3, 8, 10, 11]),
+                ("5", [5]),
+                ("0,2,", [0, 2]),
+                ("", []),
+                ("\n", [])]:
+            self.assertEqual(util.parse_cpulist(cpulist), cpus, cpulist)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, util.parse_cpulist, "0-x")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 from __future__ import with_statement
 
+import time
 import unittest
 import urllib2
 
+from feather import cache, pools, wsgi
 import greenhouse
 from base import FeatherTest
 
@@ -84,6 +86,293 @@ class WSGIServerTests(FeatherTest):
             response = sock.recv(8192)
             self.assertEqual(response, "")
 
+    def test_thread_pool(self):
+        finished = []
+
+        def app(environ, start_response):
+            if environ['PATH_INFO'] == '/slow':
+                # would block the whole process outside of a pool thread
+                time.sleep(0.2)
+            finished.append(environ['PATH_INFO'])
+            start_response("200 OK", [])
+            return [str(environ['wsgi.multithread'])]
+
+        with self.wsgi_server(app, port=7878,
+                thread_pool=pools.ThreadPool(2)):
+            socks = {}
+            for path in ('/slow', '/fast'):
+                sock = greenhouse.Socket()
+                sock.connect(("", 7878))
+                sock.sendall("GET %s HTTP/1.1\r\nHost: localhost:7878\r\n\r\n"
+                        % path)
+                socks[path] = sock
+
+            # the fast one gets its response while the slow one still runs
+            response = socks['/fast'].recv(8192)
+            self.assertEqual(response.split("\r\n\r\n")[1], "True")
+            self.assertEqual(finished, ['/fast'])
+
+            response = socks['/slow'].recv(8192)
+            self.assertEqual(response.split("\r\n\r\n")[1], "True")
+            self.assertEqual(finished, ['/fast', '/slow'])
+
+    def test_thread_pool_post(self):
+        def app(environ, start_response):
+            body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+            start_response("200 OK", [])
+            return [str(len(body))]
+
+        # small enough that the body gets spooled to a file
+        with self.wsgi_server(app, port=7879,
+                thread_pool=pools.ThreadPool(2), buffered_body_size=4096):
+            sock = greenhouse.Socket()
+            sock.connect(("", 7879))
+            sock.sendall("POST / HTTP/1.1\r\nHost: localhost:7879\r\n" +
+                    "Content-Length: 200000\r\n\r\n" + "x" * 1000)
+
+            # the rest of the body arrives while it is being buffered, before
+            # the app is run in the pool
+            greenhouse.pause_for(0.05)
+            sock.sendall("x" * 199000)
+
+            response = sock.recv(8192)
+            self.assertEqual(response.split("\r\n")[0], "HTTP/1.1 200 OK")
+            self.assertEqual(response.split("\r\n\r\n")[1], "200000")
+
+    def test_thread_pool_full(self):
+        def app(environ, start_response):
+            time.sleep(0.2)
+            start_response("200 OK", [])
+            return ["done"]
+
+        with self.wsgi_server(app, port=7880,
+                thread_pool=pools.ThreadPool(1, queue_depth=1)):
+            # one request running in the only thread, and one queued
+            socks = []
+            for i in xrange(2):
+                sock = greenhouse.Socket()
+                sock.connect(("", 7880))
+                sock.sendall("GET / HTTP/1.1\r\nHost: localhost:7880\r\n\r\n")
+                greenhouse.pause_for(0.02)
+                socks.append(sock)
+
+            # turned away without waiting for a body that never comes
+            sock = greenhouse.Socket()
+            sock.settimeout(0.1)
+            sock.connect(("", 7880))
+            sock.sendall("POST / HTTP/1.1\r\nHost: localhost:7880\r\n" +
+                    "Content-Length: 10000000\r\n\r\n")
+            self.assertEqual(sock.recv(8192).split("\r\n")[0],
+                    "HTTP/1.1 503 Service Unavailable")
+
+            for sock in socks:
+                self.assertEqual(sock.recv(8192).split("\r\n\r\n")[1],
+                        "done")
+
+    def test_response_cache(self):
+        greenhouse.emulation.patch("socket")
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            start_response("200 OK", [('Cache-Control', 'max-age=60')])
+            return ["cached"]
+
+        with self.wsgi_server(app, port=7979,
+                response_cache=cache.ResponseCache()):
+            for i in xrange(3):
+                self.assertEqual(
+                        urllib2.urlopen("http://localhost:7979/").read(),
+                        "cached")
+            urllib2.urlopen("http://localhost:7979/other").read()
+
+        self.assertEqual(calls, ["/", "/other"])
+
+    def test_response_cache_authorization(self):
+        greenhouse.emulation.patch("socket")
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ.get('HTTP_AUTHORIZATION'))
+            start_response("200 OK", [('Cache-Control', 'max-age=60')])
+            return [environ.get('HTTP_AUTHORIZATION', 'anonymous')]
+
+        with self.wsgi_server(app, port=7980,
+                response_cache=cache.ResponseCache()):
+            for credentials in ["Basic YTph", "Basic Yjpi"]:
+                request = urllib2.Request("http://localhost:7980/",
+                        headers={'Authorization': credentials})
+                self.assertEqual(urllib2.urlopen(request).read(), credentials)
+
+        self.assertEqual(calls, ["Basic YTph", "Basic Yjpi"])
+
+    def test_coalescing(self):
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            greenhouse.pause_for(0.05)
+            start_response("200 OK", [('Content-Length', '6')])
+            return ["shared"]
+
+        with self.wsgi_server(app, port=8080,
+                coalescer=cache.Coalescer()):
+            socks = []
+            for i in xrange(3):
+                sock = greenhouse.Socket()
+                sock.connect(("", 8080))
+                sock.send("GET / HTTP/1.1\r\nHost: localhost:8080\r\n\r\n")
+                socks.append(sock)
+
+            for sock in socks:
+                response = sock.recv(8192)
+                self.assertEqual(response.split("\r\n\r\n")[1], "shared")
+
+        self.assertEqual(calls, ["/"])
+
+    def concurrent_requests(self, port, request, count=3):
+        socks = []
+        for i in xrange(count):
+            sock = greenhouse.Socket()
+            sock.connect(("", port))
+            sock.sendall(request)
+            socks.append(sock)
+        return [sock.recv(8192) for sock in socks]
+
+    def test_coalescing_failure(self):
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            greenhouse.pause_for(0.05)
+            raise ValueError("leader failed")
+
+        with self.wsgi_server(app, port=8081,
+                coalescer=cache.Coalescer()):
+            responses = self.concurrent_requests(8081,
+                    "GET / HTTP/1.1\r\nHost: localhost:8081\r\n\r\n")
+
+        # the waiters get the leader's error rather than hanging
+        for response in responses:
+            self.assertEqual(response.split("\r\n")[0],
+                    "HTTP/1.1 500 Internal Server Error")
+        self.assertEqual(calls, ["/"])
+
+    def test_coalescing_timeout(self):
+        def app(environ, start_response):
+            greenhouse.pause_for(0.2)
+            start_response("200 OK", [('Content-Length', '4')])
+            return ["slow"]
+
+        with self.wsgi_server(app, port=8082,
+                coalescer=cache.Coalescer(timeout=0.05)):
+            responses = self.concurrent_requests(8082,
+                    "GET / HTTP/1.1\r\nHost: localhost:8082\r\n\r\n")
+
+        self.assertEqual(responses[0].split("\r\n")[0], "HTTP/1.1 200 OK")
+        for response in responses[1:]:
+            self.assertEqual(response.split("\r\n")[0],
+                    "HTTP/1.1 503 Service Unavailable")
+
+    def test_coalescing_exclusions(self):
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ['REQUEST_METHOD'])
+            greenhouse.pause_for(0.05)
+            start_response("200 OK", [('Content-Length', '2')])
+            return ["ok"]
+
+        with self.wsgi_server(app, port=8083,
+                coalescer=cache.Coalescer()):
+            for request in [
+                    "POST / HTTP/1.1\r\nHost: localhost:8083\r\n" +
+                        "Content-Length: 0\r\n\r\n",
+                    "GET / HTTP/1.1\r\nHost: localhost:8083\r\n" +
+                        "Authorization: Basic YTph\r\n\r\n"]:
+                for response in self.concurrent_requests(8083, request):
+                    self.assertEqual(response.split("\r\n\r\n")[1], "ok")
+
+        self.assertEqual(calls, ["POST"] * 3 + ["GET"] * 3)
+
+
+class RouterTests(unittest.TestCase):
+    def app(self, name):
+        def app(environ, start_response):
+            return name
+        return app
+
+    def test_longest_prefix(self):
+        router = wsgi.Router([
+            ('/', self.app('root')),
+            ('/api', self.app('api')),
+            ('/api/v2/', self.app('v2'))])
+
+        app, script_name, path_info = router.route('localhost', '/api/v2/x')
+        self.assertEqual(app({}, None), 'v2')
+        self.assertEqual((script_name, path_info), ('/api/v2', '/x'))
+
+        app, script_name, path_info = router.route('localhost', '/api/v3')
+        self.assertEqual(app({}, None), 'api')
+        self.assertEqual((script_name, path_info), ('/api', '/v3'))
+
+        app, script_name, path_info = router.route('localhost', '/')
+        self.assertEqual(app({}, None), 'root')
+        self.assertEqual((script_name, path_info), ('', '/'))
+
+    def test_hosts(self):
+        router = wsgi.Router([
+            ('/', self.app('default')),
+            ('/', self.app('exact'), 'api.example.com'),
+            ('/', self.app('wildcard'), '*.example.com')])
+
+        for host, name in [('api.example.com:8000', 'exact'),
+                ('www.example.com', 'wildcard'),
+                ('a.b.example.com', 'wildcard'),
+                ('example.org', 'default')]:
+            self.assertEqual(router.route(host, '/')[0]({}, None), name)
+
+    def test_no_match(self):
+        router = wsgi.Router([('/api', self.app('api'))])
+        self.assertEqual(router.route('localhost', '/other')[0], None)
+
+    def test_host_fallback(self):
+        router = wsgi.Router([
+            ('/', self.app('default')),
+            ('/static', self.app('static')),
+            ('/v1', self.app('exact'), 'api.example.com'),
+            ('/v2', self.app('wildcard'), '*.example.com')])
+
+        # a host's mounts are tried first, then wildcards for it, then the
+        # hostless mounts, whichever host-specific mounts exist
+        for host, path, name in [
+                ('api.example.com', '/v1/x', 'exact'),
+                ('api.example.com', '/v2/x', 'wildcard'),
+                ('api.example.com', '/static/x', 'static'),
+                ('api.example.com', '/other', 'default'),
+                ('API.Example.com:80', '/v1', 'exact'),
+                ('example.com', '/v2', 'default'),
+                ('www.example.com', '/v1', 'default')]:
+            self.assertEqual(router.route(host, path)[0]({}, None), name)
+
+        router = wsgi.Router([('/v1', self.app('exact'), 'api.example.com')])
+        self.assertEqual(router.route('api.example.com', '/v2'),
+                (None, '', '/v2'))
+
+    def test_parse_mount(self):
+        for mount, parsed in [
+                ('/=foo:app', ('/', 'foo:app', None)),
+                ('/api/v1=foo.api:app', ('/api/v1', 'foo.api:app', None)),
+                ('api.example.com/v1=foo:app',
+                    ('/v1', 'foo:app', 'api.example.com')),
+                ('api.example.com=foo:app', ('/', 'foo:app', 'api.example.com')),
+                ('*.example.com/=foo:app', ('/', 'foo:app', '*.example.com'))]:
+            self.assertEqual(wsgi.parse_mount(mount), parsed)
+
+        for mount in ['api=foo:app', 'api/v1=foo:app', 'localhost/=foo:app',
+                '*/=foo:app', 'www.*.com/=foo:app', '/api', '/api=']:
+            self.assertRaises(ValueError, wsgi.parse_mount, mount)
+
 
 if __name__ == '__main__':
     unittest.main()